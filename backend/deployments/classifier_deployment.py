@@ -1,22 +1,53 @@
 import os
+import re
+from collections import OrderedDict
+from typing import List
+
 import torch
 import joblib
 import numpy as np
 from ray import serve
 
 
+# Keyword heuristic, checked before any model inference
+GROUNDING_KEYWORDS = frozenset({"find", "locate", "segment", "detect"})
+CAPTION_KEYWORDS = frozenset({"caption", "describe"})
+_WORD_RE = re.compile(r"[a-z]+")
+
+CACHE_SIZE = 1024  # Max cached query -> label entries
+MAX_QUERY_TOKENS = 32  # Queries are short sentences; caps attention cost per forward
+
+# Hidden-layer activations of sklearn's MLPClassifier, for the inlined forward pass
+_ACTIVATIONS = {
+    "identity": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "tanh": lambda x: np.tanh(x, out=x),
+    "logistic": lambda x: np.reciprocal(1.0 + np.exp(-x, out=x), out=x),
+}
+
+# Normalize labels to match router expectations
+# The MLP may return "captioning" but router expects "caption"
+LABEL_MAPPING = {
+    "captioning": "caption",
+    "caption": "caption",
+    "vqa": "vqa",
+    "grounding": "grounding",
+    "area": "area",
+}
+
+
 @serve.deployment
 class TaskClassifierDeployment:
     """
-    Task classifier using BERT embeddings + MLP to classify queries as:
+    Task classifier using BERT embeddings + MLP (or a hashing + logistic
+    regression pipeline, if hash_lr.joblib is present) to classify queries as:
     - caption
     - vqa  
     - grounding
     """
     
-    def __init__(self, model_path: str = None, device: str = None):
-        from transformers import BertTokenizer, BertModel
-        
+    def __init__(self, model_path: str = None, device: str = None,
+                 max_batch_size: int = 32, batch_wait_timeout_s: float = 0.01):
         if device is None:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
@@ -24,19 +55,74 @@ class TaskClassifierDeployment:
         
         print(f"[TaskClassifier] Using device: {self.device}")
         
-        # Load BERT for embeddings
-        print("[TaskClassifier] Loading BERT tokenizer and model...")
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        self.bert = BertModel.from_pretrained('bert-base-uncased')
-        self.bert.to(self.device)
-        self.bert.eval()
+        # LRU cache of normalized query -> predicted label
+        self._cache = OrderedDict()
+        self._static_shapes = False  # Set once BERT is compiled (see _compile_bert)
+        
+        # Dynamic batching of concurrent ambiguous queries (see _classify_batched)
+        self._max_batch_size = max_batch_size
+        self._classify_batched.set_max_batch_size(max_batch_size)
+        self._classify_batched.set_batch_wait_timeout_s(batch_wait_timeout_s)
         
         # Default model path if not provided
         if model_path is None:
             model_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models", "Task_Classifier")
         
-        # Load MLP classifier, scaler, and label encoder
+        # Prefer the BERT-free hashing + logistic regression router (models/Task_Classifier/train_hash_lr.py)
+        self.pipe = None
+        if model_path:
+            self.pipe = self._load_hash_lr(os.path.join(model_path, "hash_lr.joblib"))
+        
+        if self.pipe is not None:
+            self.use_heuristic = False
+        else:
+            self._load_bert_mlp(model_path)
+
+    def _load_hash_lr(self, pipe_path: str):
+        """Load the hashing + logistic regression pipeline, or return None if unavailable."""
+        if not os.path.exists(pipe_path):
+            return None
+        try:
+            pipe = joblib.load(pipe_path)
+            print(f"[TaskClassifier] Loaded hashing + logistic regression classifier from {pipe_path}")
+            return pipe
+        except Exception as e:
+            print(f"[TaskClassifier] Failed to load {pipe_path}: {e}. Using BERT + MLP.")
+            return None
+
+    def _load_bert_mlp(self, model_path: str):
+        """Load BERT (PyTorch or INT8 ONNX) plus the MLP head, scaler and label encoder."""
+        from transformers import BertTokenizerFast, BertModel
+        
         self.use_heuristic = True
+        
+        # Prefer the INT8 ONNX encoder on CPU (built by models/Task_Classifier/quantize_bert.py)
+        self.ort_session = None
+        if self.device.type == "cpu" and model_path:
+            self.ort_session = self._load_onnx_bert(os.path.join(model_path, "bert_onnx", "model_quantized.onnx"))
+        
+        # FP32 PyTorch BERT on CPU is ~10x slower than the rest of the hot path; don't load it
+        if self.device.type == "cpu" and self.ort_session is None:
+            print("[TaskClassifier] WARNING: MLP mode requires CUDA or the INT8 ONNX encoder "
+                  "(models/Task_Classifier/quantize_bert.py). Not loading BERT on CPU; using heuristic.")
+            return
+        
+        # Load BERT for embeddings (fast tokenizer encodes batches in parallel)
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+        print("[TaskClassifier] Loading BERT tokenizer and model...")
+        self.tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+        
+        if self.ort_session is None:
+            # fp16 on GPU (tensor cores); CLS embeddings are cast back to fp32 for the MLP head
+            dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+            self.bert = BertModel.from_pretrained('bert-base-uncased', torch_dtype=dtype)
+            self.bert.to(self.device)
+            self.bert.eval()
+            
+            if self.device.type == "cuda":
+                self._compile_bert()
+        
+        # Load MLP classifier, scaler, and label encoder
         if model_path and os.path.exists(model_path):
             mlp_path = os.path.join(model_path, "mlp_query_classifier.joblib")
             scaler_path = os.path.join(model_path, "scaler_query_classifier.joblib")
@@ -48,6 +134,7 @@ class TaskClassifierDeployment:
                     self.mlp = joblib.load(mlp_path)
                     self.scaler = joblib.load(scaler_path)
                     self.label_encoder = joblib.load(le_path)
+                    self._prepare_mlp()
                     self.use_heuristic = False
                     print("[TaskClassifier] MLP classifier loaded successfully.")
                 except Exception as e:
@@ -57,22 +144,124 @@ class TaskClassifierDeployment:
         else:
             print(f"[TaskClassifier] Model path not found: {model_path}. Using heuristic.")
 
-    def _get_bert_embedding(self, text: str) -> np.ndarray:
-        """Get BERT CLS token embedding for a single text."""
+    def _prepare_mlp(self):
+        """Extract scaler and MLP parameters once so inference is plain numpy matmuls."""
+        mean = self.scaler.mean_ if getattr(self.scaler, "with_mean", True) else None
+        scale = self.scaler.scale_ if getattr(self.scaler, "with_std", True) else None
+        self._scaler_mean = None if mean is None else mean.astype(np.float32)
+        self._scaler_scale_inv = None if scale is None else (1.0 / scale).astype(np.float32)
+        
+        self._W = [np.ascontiguousarray(c, dtype=np.float32) for c in self.mlp.coefs_]
+        self._b = [np.ascontiguousarray(b, dtype=np.float32) for b in self.mlp.intercepts_]
+        self._activation = _ACTIVATIONS[self.mlp.activation]
+        self._classes = self.mlp.classes_
+    
+    def _scale(self, x: np.ndarray) -> np.ndarray:
+        """Inlined StandardScaler.transform."""
+        x = x.astype(np.float32)
+        if self._scaler_mean is not None:
+            x = x - self._scaler_mean
+        if self._scaler_scale_inv is not None:
+            x = x * self._scaler_scale_inv
+        return x
+    
+    def _mlp(self, x: np.ndarray) -> np.ndarray:
+        """Inlined MLPClassifier.predict: hidden layers, output logits, argmax."""
+        for W, b in zip(self._W[:-1], self._b[:-1]):
+            x = self._activation(x @ W + b)
+        logits = x @ self._W[-1] + self._b[-1]
+        if logits.shape[1] == 1:
+            # Binary MLPs have a single logistic output unit
+            return self._classes[(logits[:, 0] > 0).astype(np.intp)]
+        return self._classes[logits.argmax(-1)]
+    
+    def _load_onnx_bert(self, onnx_path: str):
+        """Load the quantized ONNX BERT encoder, or return None if unavailable."""
+        if not os.path.exists(onnx_path):
+            return None
+        try:
+            import onnxruntime as ort
+            session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+            self.ort_input_names = {i.name for i in session.get_inputs()}
+            print(f"[TaskClassifier] Loaded INT8 ONNX BERT from {onnx_path}")
+            return session
+        except Exception as e:
+            print(f"[TaskClassifier] Failed to load ONNX BERT: {e}. Using PyTorch BERT.")
+            return None
+
+    def _compile_bert(self):
+        """Compile BERT with CUDA graphs; inputs are padded to a few fixed shapes to avoid recompiles."""
+        try:
+            self.bert = torch.compile(self.bert, mode="reduce-overhead")
+            self._static_shapes = True
+            # Warm up every padded batch shape so compilation happens before the first request
+            # (batches pad up to a power of two, so that includes the one at or above max_batch_size)
+            batch, largest = 1, 1 << (self._max_batch_size - 1).bit_length()
+            while batch <= largest:
+                self._get_bert_embeddings(["warmup"] * batch)
+                batch *= 2
+            print("[TaskClassifier] BERT compiled and warmed up.")
+        except Exception as e:
+            print(f"[TaskClassifier] torch.compile failed ({e}); using eager BERT.")
+            self.bert = getattr(self.bert, "_orig_mod", self.bert)
+            self._static_shapes = False
+
+    def _get_bert_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Get BERT CLS token embeddings for a batch of texts, one row per text."""
+        if self.ort_session is not None:
+            inputs = self.tokenizer(
+                texts,
+                padding=True,
+                truncation=True,
+                max_length=MAX_QUERY_TOKENS,
+                return_tensors="np"
+            )
+            feeds = {k: v.astype(np.int64) for k, v in inputs.items() if k in self.ort_input_names}
+            last_hidden_state = self.ort_session.run(None, feeds)[0]
+            return last_hidden_state[:, 0, :]
+        
+        n = len(texts)
+        if self._static_shapes:
+            # Fixed sequence length and power-of-two batch sizes keep the compiled graph set small
+            texts = texts + [""] * ((1 << (n - 1).bit_length()) - n)
+        
         inputs = self.tokenizer(
-            text,
-            padding=True,
+            texts,
+            padding="max_length" if self._static_shapes else True,
             truncation=True,
-            max_length=128,
+            max_length=MAX_QUERY_TOKENS,
             return_tensors="pt"
         ).to(self.device)
         
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.bert(**inputs)
         
-        # CLS token embedding
-        cls_embedding = outputs.last_hidden_state[:, 0, :]
-        return cls_embedding.cpu().numpy()
+        # CLS token embeddings
+        cls_embeddings = outputs.last_hidden_state[:n, 0, :]
+        return cls_embeddings.float().cpu().numpy()
+
+    @serve.batch(max_batch_size=32, batch_wait_timeout_s=0.01)
+    async def _classify_batched(self, texts: List[str]) -> List[str]:
+        """Classify concurrent queries with a single BERT forward and MLP pass."""
+        if self.pipe is not None:
+            return [LABEL_MAPPING.get(label, label) for label in self.pipe.predict(texts)]
+        
+        embeddings = self._get_bert_embeddings(texts)
+        embeddings_scaled = self._scale(embeddings)
+        pred_indices = self._mlp(embeddings_scaled)
+        labels = self.label_encoder.inverse_transform(pred_indices)
+        return [LABEL_MAPPING.get(label, label) for label in labels]
+
+    def _keyword_task(self, text: str, text_lower: str):
+        """Resolve obvious queries from surface keywords. Returns None if ambiguous."""
+        words = set(_WORD_RE.findall(text_lower))
+        if not words.isdisjoint(GROUNDING_KEYWORDS):
+            return "grounding"
+        if not words.isdisjoint(CAPTION_KEYWORDS):
+            return "caption"
+        if "?" in text:
+            return "vqa"
+        return None
 
     async def predict(self, text: str) -> str:
         """
@@ -85,30 +274,24 @@ class TaskClassifierDeployment:
         if "area" in text_lower:
             return "area"
         
+        # Fast path: obvious keywords never need a BERT forward pass
+        task = self._keyword_task(text, text_lower)
+        if task is not None:
+            return task
+        
         if self.use_heuristic:
             # Fallback to simple heuristic
-            if "find" in text_lower or "locate" in text_lower or "segment" in text_lower or "detect" in text_lower:
-                return "grounding"
-            if "caption" in text_lower or "describe" in text_lower:
-                return "caption"
-            if "?" in text:
-                return "vqa"
             return "caption"
         
-        # Use MLP classifier
-        embedding = self._get_bert_embedding(text)
-        embedding_scaled = self.scaler.transform(embedding)
-        pred_idx = self.mlp.predict(embedding_scaled)
-        label = self.label_encoder.inverse_transform(pred_idx)[0]
-        
-        # Normalize labels to match router expectations
-        # The MLP may return "captioning" but router expects "caption"
-        label_mapping = {
-            "captioning": "caption",
-            "caption": "caption",
-            "vqa": "vqa",
-            "grounding": "grounding",
-            "area": "area",
-        }
-        
-        return label_mapping.get(label, label)
+        key = text.strip().lower()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        
+        # Use MLP classifier for ambiguous queries (batched across concurrent requests)
+        label = await self._classify_batched(text)
+        
+        self._cache[key] = label
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return label
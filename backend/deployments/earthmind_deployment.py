@@ -3,12 +3,13 @@ import torch
 from ray import serve
 from PIL import Image
 
-from utils_pkg import EarthMindEfficientPreprocessor, mask_to_base64, get_cleaned_obbs, get_seg_hidden_states
+from utils_pkg import EarthMindEfficientPreprocessor, mask_to_base64, get_cleaned_obbs, get_seg_hidden_states, resolve_frames
 
 
 @serve.deployment
 class EarthMindDeployment:
-    def __init__(self, model_path: str, load_8bit: bool = False, dtype: str = "auto", device: str = None):
+    def __init__(self, model_path: str, load_8bit: bool = False, dtype: str = "bfloat16", device: str = None,
+                 compile: bool = False):
         from transformers import AutoModelForCausalLM, AutoTokenizer
         
         self.model_path = model_path
@@ -19,6 +20,13 @@ class EarthMindDeployment:
             device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.device = device
 
+        if torch.cuda.is_available():
+            # TF32 for any remaining fp32 matmuls; allow fused SDPA kernels
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+
         # Load model and tokenizer
         model_kwargs = {"trust_remote_code": True}
 
@@ -60,12 +68,69 @@ class EarthMindDeployment:
             # For non-8bit, just initialize normally
             self.model.preparing_for_generation(self.tokenizer, torch_dtype=self.model.dtype)
         
+        # Optionally compile the language model forward (generate() calls it once per decode step).
+        # dynamic=True because the KV cache grows and multimodal prompt lengths vary; default mode
+        # (no CUDA graphs) so outputs, including the attention maps captured for tile selection,
+        # are not overwritten by the next replay
+        if compile and torch.cuda.is_available() and not self.load_8bit:
+            language_model = self.model.language_model
+            language_model.forward = torch.compile(language_model.forward, mode="default", dynamic=True)
+            self._warmup()
+        
         # Initialize efficient preprocessor for VQA tasks
         self.efficient_preprocessor = EarthMindEfficientPreprocessor(
             self.model, self.tokenizer, device=self.device, area_threshold=600000
         )
+        
+        # Reusable VQA input buffers: host staging (pinned on GPU) + device copies
+        pin = str(self.device).startswith("cuda")
+        max_tiles = self.model.max_dynamic_patch + int(self.model.use_thumbnail)
+        tile_shape = (max_tiles, 3, self.model.image_size, self.model.image_size)
+        self._tile_staging = torch.empty(tile_shape, dtype=self.model.dtype, pin_memory=pin)
+        self._tile_device = torch.empty(tile_shape, dtype=self.model.dtype, device=self.device)
+        
+        # Grounding (SAM2) preprocessing as one on-device pass: scale to [0, 1], resize
+        # like DirectResize, normalize like grounding_encoder.preprocess_image
+        from torchvision.transforms import v2
+        g_size = self.model.extra_image_processor.target_length
+        encoder = self.model.grounding_encoder
+        self._g_preproc = v2.Compose([
+            v2.ToDtype(torch.float32, scale=True),
+            v2.Resize((g_size, g_size), interpolation=v2.InterpolationMode.BICUBIC, antialias=True),
+            v2.Normalize(mean=list(encoder.img_mean), std=list(encoder.img_std)),
+        ])
+
+    def _warmup(self):
+        """Run an image+text prompt so compilation happens before the first request."""
+        try:
+            img = Image.new("RGB", (self.model.image_size, self.model.image_size))
+            with torch.no_grad():
+                self.model.predict_forward(image=img, text="<image>Describe the image.", tokenizer=self.tokenizer)
+            print("EarthMind language model compiled and warmed up.")
+        except Exception as e:
+            print(f"EarthMind warmup failed (continuing without warm cache): {e}")
+
+    def _stage_tiles(self, tiles: list) -> torch.Tensor:
+        """Transform tiles into the pinned staging buffer and issue one H2D copy."""
+        n = len(tiles)
+        if n > self._tile_staging.shape[0]:
+            pixel_values = [self.model.transformer(tile) for tile in tiles]
+            return torch.stack(pixel_values).to(self.model.dtype).to(self.device)
+        for i, tile in enumerate(tiles):
+            self._tile_staging[i].copy_(self.model.transformer(tile))
+        self._tile_device[:n].copy_(self._tile_staging[:n], non_blocking=True)
+        return self._tile_device[:n]
+
+    def _preprocess_grounding_image(self, img: Image.Image) -> torch.Tensor:
+        """Upload the raw uint8 image once and run SAM2 preprocessing on device."""
+        rgb = img if img.mode == "RGB" else img.convert("RGB")
+        raw = torch.from_numpy(np.asarray(rgb)).to(self.device, non_blocking=True)
+        g_pixel_values = self._g_preproc(raw.permute(2, 0, 1))
+        return g_pixel_values.unsqueeze(0).to(self.model.dtype)
 
     async def predict(self, text: str, frames: list, select: int = -1, task_type: str = None):
+        frames = await resolve_frames(frames)
+        
         if not text.startswith("<image>"):
             text = "<image>" + text
 
@@ -85,32 +150,16 @@ class EarthMindDeployment:
                 )
                 
                 # Prepare inputs with selected tiles
-                pixel_values = [self.model.transformer(tile) for tile in selected_tiles]
-                pixel_values = torch.stack(pixel_values).to(self.model.dtype).to(self.device)
+                pixel_values = self._stage_tiles(selected_tiles)
                 
                 num_image_tokens = len(selected_tiles) * self.model.patch_token
                 
-                # Prepare text
-                image_token_str = f'{self.model.IMG_START_TOKEN}' \
-                                  f'{self.model.IMG_CONTEXT_TOKEN * num_image_tokens}' \
-                                  f'{self.model.IMG_END_TOKEN}'
-                                  
-                text_input = text.replace('<image>', image_token_str)
-                input_text = self.model.template['INSTRUCTION'].format(
-                    input=text_input, round=1, bot_name=self.model.bot_name)
-                    
-                ids = self.tokenizer.encode(input_text)
-                ids = torch.tensor(ids).to(self.device).unsqueeze(0)
+                # Prepare text (image context ids are spliced in, not tokenized)
+                ids = self.efficient_preprocessor.build_input_ids(text, num_image_tokens)
                 attention_mask = torch.ones_like(ids, dtype=torch.bool)
                 
                 # Grounding inputs
-                g_image = np.array(img)
-                g_image = self.model.extra_image_processor.apply_image(g_image)
-                g_pixel_values = torch.from_numpy(g_image).permute(2, 0, 1).contiguous().to(self.model.dtype)
-                extra_pixel_values = [g_pixel_values]
-                g_pixel_values = torch.stack([
-                    self.model.grounding_encoder.preprocess_image(pixel) for pixel in extra_pixel_values
-                ]).to(self.model.dtype).to(self.device)
+                g_pixel_values = self._preprocess_grounding_image(img)
                 
                 mm_inputs = {
                     'pixel_values': pixel_values,
@@ -162,18 +211,15 @@ class EarthMindDeployment:
                     pred_masks = self.model.grounding_encoder.language_embd_inference(sam_states, [seg_hidden_states] * num_frames)
                     w, h = ori_image_size
                     masks = F.interpolate(pred_masks, size=(h, w), mode='bilinear', align_corners=False)
-                    masks = masks[:, 0]
-                    masks = masks.sigmoid() > 0.5
-                    masks = masks.cpu().numpy()
-                    ret_masks.append(masks)
+                    # sigmoid(x) > 0.5 <=> x > 0; keep on device until all masks are ready
+                    ret_masks.append(masks[:, 0] > 0.0)
 
                 result = {"prediction": prediction}
                 if ret_masks:
-                    # Combine all masks
-                    combined_mask = np.zeros_like(ret_masks[0], dtype=bool)
-                    for m in ret_masks:
-                        combined_mask = combined_mask | m
-                    result["mask"] = combined_mask
+                    # Transfer all per-object masks in one copy; keep them for per-object OBBs
+                    object_masks = torch.stack(ret_masks).cpu().numpy()
+                    result["mask"] = object_masks.any(axis=0)
+                    result["object_masks"] = list(object_masks)
             else:
                 # Standard inference for non-VQA tasks
                 if select and select > 0:
@@ -191,23 +237,23 @@ class EarthMindDeployment:
         # Check for mask in result - handle both "mask" (from VQA path) and "prediction_masks" (from predict_forward)
         if isinstance(result, dict):
             mask_np = None
+            object_masks = []
             
             if "mask" in result:
-                # From VQA path - already a combined numpy array
+                # From VQA path - combined mask plus the per-object masks
                 mask_np = result["mask"]
+                object_masks = result.get("object_masks", [mask_np])
             elif "prediction_masks" in result and result["prediction_masks"]:
                 # From predict_forward - list of mask arrays
-                ret_masks = result["prediction_masks"]
-                if len(ret_masks) > 0:
-                    # Combine all masks
-                    combined_mask = np.zeros_like(ret_masks[0], dtype=bool)
-                    for m in ret_masks:
-                        combined_mask = combined_mask | m
-                    mask_np = combined_mask
+                object_masks = result["prediction_masks"]
+                if len(object_masks) > 0:
+                    # Combine all masks in a single vectorized pass
+                    mask_np = np.logical_or.reduce(object_masks)
             
             if mask_np is not None:
                 mask_b64 = mask_to_base64(mask_np)
-                obbs = get_cleaned_obbs(mask_np)
+                # Extract OBBs per object so touching objects from different masks stay separate
+                obbs = [obb for m in object_masks for obb in get_cleaned_obbs(m)]
         
         token = '<|end|>'
         if prediction.endswith(token):
@@ -1,7 +1,11 @@
+import copy
 import logging
+from collections import OrderedDict
 import torch
 from ray import serve
 
+from utils_pkg import RegexRefiner
+
 # Set up logging
 logger = logging.getLogger("phi_deployment")
 logger.setLevel(logging.DEBUG)
@@ -11,6 +15,9 @@ if not logger.handlers:
     logger.addHandler(handler)
 
 
+MAX_NEW_TOKENS = 30  # Refined phrases are short
+CACHE_SIZE = 1024  # Max cached query -> refined prompt entries
+
 SYSTEM_INSTRUCTION = """You are a Refiner for Visual Grounding (RemoteSAM/CLIP).
 Your goal is to prepare text for a segmentation model by removing "command syntax" and "meta-noise" while preserving every visual detail.
 
@@ -62,31 +69,149 @@ Output: stadium
 class PhiDeployment:
     """Phi-3.5 Mini Instruct deployment for prompt refinement before RemoteSAM."""
     
-    def __init__(self, model_id: str = "microsoft/Phi-3.5-mini-instruct", device: str = None):
-        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+    def __init__(self, model_id: str = "microsoft/Phi-3.5-mini-instruct", device: str = None,
+                 draft_model_id: str = None):
+        from transformers import AutoModelForCausalLM, AutoTokenizer, TorchAoConfig
         
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
         
-        print(f"Loading Phi-3.5 Mini Instruct from {model_id} on {device} (4-bit quantized)")
+        # LRU cache of normalized query -> refined prompt
+        self._cache = OrderedDict()
+        
+        # Rule-based rewriter tried before the LLM; counters track how often it falls through
+        self.regex_refiner = RegexRefiner()
+        self._regex_hits = 0
+        self._llm_fallbacks = 0
+        
+        print(f"Loading Phi-3.5 Mini Instruct from {model_id} on {device} (int4 weight-only)")
         self.tokenizer = AutoTokenizer.from_pretrained(model_id)
         
-        # 4-bit quantization config for reduced memory usage
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_use_double_quant=True
-        )
-        
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_id,
-            quantization_config=quantization_config,
-            device_map="auto",
-            trust_remote_code=True
-        )
-        print("Phi-3.5 Mini Instruct loaded (4-bit).")
+        model_kwargs = {"torch_dtype": torch.bfloat16, "device_map": "auto"}
+        if torch.cuda.is_available():
+            # TorchAO int4 weight-only quantization (tinygemm kernels need CUDA + bf16)
+            from torchao.quantization import Int4WeightOnlyConfig
+            model_kwargs["quantization_config"] = TorchAoConfig(quant_type=Int4WeightOnlyConfig(group_size=128))
+        
+        # Use the native transformers Phi-3 implementation; the remote modeling code
+        # predates the current Cache API and is what broke use_cache=True
+        self.model = AutoModelForCausalLM.from_pretrained(model_id, **model_kwargs)
+        self.model.eval()
+        print("Phi-3.5 Mini Instruct loaded (int4 weight-only).")
+        
+        # Optional small draft model for assisted (speculative) greedy decoding
+        self.draft_model = None
+        self.draft_tokenizer = None
+        self._draft_shares_vocab = True
+        if draft_model_id:
+            print(f"Loading draft model {draft_model_id} for assisted decoding")
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_id, torch_dtype=torch.bfloat16, device_map="auto"
+            )
+            self.draft_model.eval()
+            self.draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_id)
+            # A draft from another tokenizer family needs both tokenizers (universal assisted decoding)
+            self._draft_shares_vocab = self.draft_tokenizer.get_vocab() == self.tokenizer.get_vocab()
+        
+        # Render the chat template once; requests only splice in the user query
+        placeholder = "\x00QUERY\x00"
+        messages = [
+            {"role": "system", "content": SYSTEM_INSTRUCTION},
+            {"role": "user", "content": f"Input: {placeholder}\nOutput:"}
+        ]
+        rendered = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        self._prompt_head, self._prompt_tail = rendered.split(placeholder)
+        
+        # Greedy decoding stops at end-of-turn tokens or at the end of the first line
+        eos = self.model.generation_config.eos_token_id
+        self._stop_ids = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+        for token in ("<|end|>", "<|endoftext|>"):
+            token_id = self.tokenizer.convert_tokens_to_ids(token)
+            if token_id is not None and token_id != self.tokenizer.unk_token_id:
+                self._stop_ids.add(token_id)
+        self._newline_id = self.tokenizer.convert_tokens_to_ids("<0x0A>")
+        
+        # Pre-fill the KV cache for the fixed system prompt once; every request reuses it
+        self._prefix_ids = self._shared_prompt_prefix()
+        with torch.no_grad():
+            prefix_out = self.model(self._prefix_ids, use_cache=True, logits_to_keep=1)
+        self._prefix_cache = prefix_out.past_key_values
+        logger.info(f"Cached KV for {self._prefix_ids.shape[1]}-token system prompt prefix")
+    
+    def _build_input_ids(self, user_query: str) -> torch.Tensor:
+        # Same ids as apply_chat_template(..., add_generation_prompt=True), without re-rendering
+        prompt = self._prompt_head + user_query + self._prompt_tail
+        return self.tokenizer(
+            prompt,
+            add_special_tokens=False,
+            return_tensors="pt"
+        ).input_ids.to(self.device)
+    
+    def _shared_prompt_prefix(self) -> torch.Tensor:
+        """Token ids shared by every templated prompt (system turn + user preamble)."""
+        a = self._build_input_ids("a")[0]
+        b = self._build_input_ids("b")[0]
+        n = min(len(a), len(b))
+        mismatch = (a[:n] != b[:n]).nonzero()
+        prefix_len = int(mismatch[0]) if len(mismatch) else n - 1
+        return a[:prefix_len].unsqueeze(0)
+    
+    def _llm_refine(self, user_query: str) -> str:
+        """Refine a query the regex rules could not handle with greedy Phi-3.5 decoding."""
+        inputs = self._build_input_ids(user_query)
+        
+        if self.draft_model is not None:
+            return self._assisted_refine(inputs)
+        
+        # Reuse the pre-filled system prompt KV cache when the prompt starts with it
+        prefix_len = self._prefix_ids.shape[1]
+        past_key_values = None
+        if inputs.shape[1] > prefix_len and torch.equal(inputs[:, :prefix_len], self._prefix_ids):
+            past_key_values = copy.deepcopy(self._prefix_cache)
+        
+        # Hand-rolled greedy decode: one forward + argmax per token, no generate() plumbing
+        generated = []
+        with torch.no_grad():
+            if past_key_values is not None:
+                outputs = self.model(inputs[:, prefix_len:], past_key_values=past_key_values,
+                                     use_cache=True, logits_to_keep=1)
+            else:
+                outputs = self.model(inputs, use_cache=True, logits_to_keep=1)
+            
+            while True:
+                next_tok = outputs.logits[:, -1, :].argmax(-1, keepdim=True)
+                tok_id = next_tok.item()
+                if tok_id in self._stop_ids or (tok_id == self._newline_id and generated):
+                    break
+                generated.append(tok_id)
+                if len(generated) >= MAX_NEW_TOKENS:
+                    break
+                outputs = self.model(next_tok, past_key_values=outputs.past_key_values, use_cache=True)
+        
+        response = self.tokenizer.decode(generated, skip_special_tokens=True)
+        return response.strip()
+    
+    def _assisted_refine(self, inputs: torch.Tensor) -> str:
+        """Greedy decode verified against draft-model proposals via HF assisted generation."""
+        kwargs = {}
+        if not self._draft_shares_vocab:
+            kwargs = {"tokenizer": self.tokenizer, "assistant_tokenizer": self.draft_tokenizer}
+        with torch.no_grad():
+            output = self.model.generate(
+                inputs,
+                attention_mask=torch.ones_like(inputs),
+                assistant_model=self.draft_model,
+                max_new_tokens=MAX_NEW_TOKENS,
+                do_sample=False,
+                eos_token_id=list(self._stop_ids),
+                pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id,
+                **kwargs
+            )
+        response = self.tokenizer.decode(output[0, inputs.shape[1]:], skip_special_tokens=True)
+        # Same single-line output as the hand-rolled loop
+        lines = response.strip().splitlines()
+        return lines[0].strip() if lines else ""
     
     async def refine_prompt(self, user_query: str) -> str:
         """
@@ -99,40 +224,32 @@ class PhiDeployment:
         Returns:
             The refined prompt suitable for RemoteSAM
         """
-        messages = [
-            {"role": "system", "content": SYSTEM_INSTRUCTION},
-            {"role": "user", "content": f"Input: {user_query}\nOutput:"}
-        ]
-        
-        # Create the prompt using the model's specific template
-        inputs = self.tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            return_tensors="pt"
-        ).to(self.device)
-        
-        # Generate with strict limits to prevent hallucination
-        outputs = self.model.generate(
-            inputs,
-            max_new_tokens=30,  # Keep it short
-            temperature=0.1,   # Low temp = deterministic
-            do_sample=False,   # Greedy decoding is usually best for extraction
-            use_cache=False    # Avoid DynamicCache compatibility issues
-        )
+        key = user_query.strip().lower()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
         
-        # Decode and strip the prompt
-        response = self.tokenizer.decode(
-            outputs[0][inputs.shape[1]:], 
-            skip_special_tokens=True
-        )
+        refined = self.regex_refiner.refine(user_query)
+        if refined is not None:
+            self._regex_hits += 1
+            source = "REGEX"
+        else:
+            self._llm_fallbacks += 1
+            source = "LLM"
+            refined = self._llm_refine(user_query)
         
-        refined = response.strip()
+        total = self._regex_hits + self._llm_fallbacks
+        logger.debug("LLM fall-through rate: %d/%d (%.1f%%)",
+                     self._llm_fallbacks, total, 100.0 * self._llm_fallbacks / total)
         
         # Debug logging for prompt refinement (using print for Ray Serve visibility)
         print("=" * 60)
         print("[PHI] PROMPT REFINEMENT")
         print(f"[PHI]   INPUT:  '{user_query}'")
-        print(f"[PHI]   OUTPUT: '{refined}'")
+        print(f"[PHI]   OUTPUT: '{refined}' ({source})")
         print("=" * 60)
         
+        self._cache[key] = refined
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
         return refined
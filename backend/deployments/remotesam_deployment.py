@@ -4,7 +4,8 @@ import numpy as np
 import torch
 from ray import serve
 
-from utils_pkg import mask_to_base64, get_cleaned_obbs
+from utils_pkg import mask_to_base64, get_cleaned_obbs, resolve_frames
+from utils_pkg.utils import calculate_area_from_mask
 
 
 @serve.deployment
@@ -14,57 +15,67 @@ class RemoteSAMDeployment:
         import cv2
         import numpy as np
         
-        # Add RemoteSAM directory to sys.path
+        # RemoteSAM's code uses top-level imports ('tasks', 'utils', 'transforms', 'args',
+        # 'lib') and relative file access from its root, so import and build it with its
+        # directories on sys.path and the cwd switched, then restore both for the process.
         # We assume the checkpoint is at .../RemoteSAM/pretrained_weights/file.pth
         # So we go up two levels to get to .../RemoteSAM
+        checkpoint_path = os.path.abspath(checkpoint_path)
         remotesam_root = os.path.abspath(os.path.join(os.path.dirname(checkpoint_path), ".."))
         print(f"Adding {remotesam_root} to sys.path for RemoteSAM")
         
-        # Add all necessary paths for RemoteSAM imports
         paths_to_add = [
             remotesam_root,  # For 'tasks', 'utils', 'transforms', 'args', 'lib'
             os.path.join(remotesam_root, "tasks"),  # For 'code' subpackage access
             os.path.join(remotesam_root, "tasks", "code"),  # For relative imports within code
         ]
-        
-        for path in paths_to_add:
-            if path not in sys.path:
-                sys.path.insert(0, path)
-            else:
-                # Move to front if already exists but not at front
-                sys.path.remove(path)
-                sys.path.insert(0, path)
-        
-        # Also change working directory to RemoteSAM root for relative file access
+        original_sys_path = list(sys.path)
         original_cwd = os.getcwd()
-        os.chdir(remotesam_root)
-            
-        try:
-            import tasks
-            print(f"Imported 'tasks' from: {os.path.dirname(tasks.__file__) if hasattr(tasks, '__file__') else 'unknown'}")
-            from tasks.code.model import RemoteSAM, init_demo_model
-        except ImportError as e:
-            print(f"Failed to import RemoteSAM modules: {e}")
-            print(f"sys.path: {sys.path}")
-            print(f"Current working directory: {os.getcwd()}")
-            print(f"RemoteSAM root exists: {os.path.exists(remotesam_root)}")
-            print(f"Tasks folder exists: {os.path.exists(os.path.join(remotesam_root, 'tasks'))}")
-            os.chdir(original_cwd)
-            raise e
-
+        
         if device is None:
             device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.device = device
         
-        print(f"Loading RemoteSAM from {checkpoint_path} on {device}")
-        model = init_demo_model(checkpoint_path, device)
-        self.model = RemoteSAM(model, device, use_EPOC=True)
-        print("RemoteSAM loaded.")
+        try:
+            for path in paths_to_add:
+                if path in sys.path:
+                    sys.path.remove(path)
+                sys.path.insert(0, path)
+            os.chdir(remotesam_root)
+            
+            try:
+                import tasks
+                print(f"Imported 'tasks' from: {os.path.dirname(tasks.__file__) if hasattr(tasks, '__file__') else 'unknown'}")
+                from tasks.code.model import RemoteSAM, init_demo_model
+            except ImportError as e:
+                print(f"Failed to import RemoteSAM modules: {e}")
+                print(f"sys.path: {sys.path}")
+                print(f"Current working directory: {os.getcwd()}")
+                print(f"RemoteSAM root exists: {os.path.exists(remotesam_root)}")
+                print(f"Tasks folder exists: {os.path.exists(os.path.join(remotesam_root, 'tasks'))}")
+                raise e
+            
+            print(f"Loading RemoteSAM from {checkpoint_path} on {device}")
+            model = init_demo_model(checkpoint_path, device)
+            self.model = RemoteSAM(model, device, use_EPOC=True)
+            print("RemoteSAM loaded.")
+        finally:
+            os.chdir(original_cwd)
+            sys.path[:] = original_sys_path
 
-    async def predict(self, text: str, frames: list, select: int = -1):
+    async def predict(self, text: str, frames: list, select: int = -1,
+                      compute_area: bool = False, gsd: float = 1.0, return_mask: bool = True):
+        """
+        Segment the object referred to by `text`.
+        
+        With compute_area=True the area (largest contour, in m^2 for the given GSD) is
+        computed here and returned instead of OBBs; return_mask=False skips encoding the mask.
+        """
         import cv2
         import numpy as np
         
+        frames = await resolve_frames(frames)
+        
         # RemoteSAM typically works on a single image. 
         # If multiple frames, use the selected one or the first one.
         if not frames:
@@ -75,21 +86,28 @@ class RemoteSAMDeployment:
         else:
             pil_img = frames[0]
             
-        # Convert PIL to numpy (RGB)
-        image_np = np.array(pil_img)
-        
-        # RemoteSAM expects RGB image (based on test.py: cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        # But wait, test.py reads with cv2.imread (BGR), then converts to RGB.
-        # Our image_np is already RGB from PIL.
-        # So we pass it directly.
+        # referring_seg converts ndarrays back to PIL (check_input), so hand it the
+        # PIL image directly instead of materializing an RGB copy in numpy
+        image = pil_img if pil_img.mode == "RGB" else pil_img.convert("RGB")
         
         try:
-            mask = self.model.referring_seg(image=image_np, sentence=text)
+            mask = self.model.referring_seg(image=image, sentence=text)
         except Exception as e:
             raise RuntimeError(f"RemoteSAM inference failed: {e}")
 
         # mask is a numpy array
-        mask_b64 = mask_to_base64(mask)
+        if compute_area:
+            result = {"prediction": ""}
+            try:
+                result["area_sq_meters"] = float(calculate_area_from_mask(mask, gsd))
+            except Exception as e:
+                print(f"Error calculating area from mask: {e}")
+                result["error"] = str(e)
+            if return_mask:
+                result["mask"] = mask_to_base64(mask)
+            return result
+        
+        mask_b64 = mask_to_base64(mask) if return_mask else ""
         obbs = get_cleaned_obbs(mask)
         
         return {
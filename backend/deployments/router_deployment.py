@@ -1,51 +1,79 @@
+import asyncio
+import functools
 import io
+import logging
 import os
 import random
-import urllib.request
+import re
 import base64
+from collections import OrderedDict
 
+import aiohttp
+import cv2
+import grpc
 import numpy as np
+import orjson
+import ray
 from ray import serve
 from PIL import Image
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from ray.serve.grpc_util import RayServegRPCContext
 
-from utils_pkg.utils import calculate_area_from_mask
+from protos.drishti_pb2 import OrientedBox, PredictRequest, PredictResponse
 
-import re
+# Per-request routing decisions are logged at DEBUG; set ROUTER_LOG_LEVEL=DEBUG to see them
+logger = logging.getLogger("router_deployment")
+logger.setLevel(os.environ.get("ROUTER_LOG_LEVEL", "INFO"))
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(asctime)s] [ROUTER] %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+
+def decode_image_bytes(data: bytes) -> np.ndarray:
+    """Decode encoded image bytes to an HxWx3 uint8 RGB array, using OpenCV's decoder when it can."""
+    # Ignore EXIF orientation so pixels match what PIL's Image.open returned before
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        # Formats OpenCV can't read (e.g. GIF) go through PIL
+        return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
-def pil_from_base64(b64_string: str) -> Image.Image:
+def load_image_file(path: str) -> np.ndarray:
+    with open(path, "rb") as f:
+        return decode_image_bytes(f.read())
+
+
+def image_from_base64(b64_string: str) -> np.ndarray:
     try:
         decoded = base64.b64decode(b64_string)
-        return Image.open(io.BytesIO(decoded)).convert("RGB")
+        return decode_image_bytes(decoded)
     except Exception as e:
         raise ValueError(f"Failed to parse base64 image: {e}")
 
 
+_YES_NO_RE = re.compile(r"\b(yes|no)\b", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"-?\d+\.?\d*")
+
+
 def parse_binary_response(response: str) -> str:
     """Parse binary response to strictly return 'Yes' or 'No'."""
-    response_lower = response.strip().lower()
-    has_yes = "yes" in response_lower
-    has_no = "no" in response_lower
-    
-    # Check for exclusive presence
-    if has_yes and not has_no:
+    # The first standalone yes/no decides; default to No if neither is present
+    match = _YES_NO_RE.search(response)
+    if match and match.group(1).lower() == "yes":
         return "Yes"
-    elif has_no and not has_yes:
-        return "No"
-    # Fallback: default to No if both or neither present
     return "No"
 
 
 def parse_numeric_response(response: str) -> float:
     """Parse response to extract numeric value as float."""
-    # Try to find any number (integer or float) in the response
-    numbers = re.findall(r'-?\d+\.?\d*', response)
-    if numbers:
-        # Return the first number found as float
-        return float(numbers[0])
+    # Return the first number (integer or float) found in the response
+    match = _NUMBER_RE.search(response)
+    if match:
+        return float(match.group())
     return 0.0
 
 
@@ -53,10 +81,14 @@ def parse_semantic_response(response: str) -> str:
     """Parse response to limit to 1-5 words."""
     words = response.strip().split()
     # Take only the first 5 words
-    return " ".join(words[:10])
+    return " ".join(words[:5])
+
 
+PHI_CACHE_SIZE = 1024  # Max cached prompt -> refinement futures
+HTTP_POOL_SIZE = 32  # Max pooled keep-alive connections for image downloads
 
-app = FastAPI()
+
+app = FastAPI(default_response_class=ORJSONResponse)
 # CORS is handled by Ray Serve proxy in serve.py
 
 
@@ -69,6 +101,68 @@ class RouterDeployment:
         self.classifier = classifier_handle
         self.phi = phi_handle
         self.models = ["earthmind", "remotesam"]
+        self._http_session = None  # Created lazily on this replica's event loop
+        
+        # LRU of normalized prompt -> Phi-3.5 refinement future; concurrent duplicates share one call
+        self._phi_cache = OrderedDict()
+        self._phi_waiters = {}
+        
+        # Requests this replica currently has in flight per model (for the no-classifier fallback)
+        self._inflight = {m: 0 for m in self.models}
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """Shared HTTP session for image downloads (connection reuse across requests)."""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60),
+                headers={'User-Agent': 'Mozilla/5.0'},
+            )
+        return self._http_session
+
+    async def __del__(self):
+        # Ray Serve awaits this when the replica shuts down (scale-down, restart, redeploy)
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+
+    def _start_refine(self, text: str) -> asyncio.Future:
+        """Start (or join) the Phi-3.5 refinement of a prompt without waiting for it."""
+        key = text.strip().lower()
+        fut = self._phi_cache.get(key)
+        if fut is not None:
+            self._phi_cache.move_to_end(key)
+            return fut
+        fut = asyncio.ensure_future(self.phi.refine_prompt.remote(text))
+        fut.add_done_callback(functools.partial(self._on_refine_done, key))
+        self._phi_cache[key] = fut
+        if len(self._phi_cache) > PHI_CACHE_SIZE:
+            self._phi_cache.popitem(last=False)
+        return fut
+
+    def _on_refine_done(self, key: str, fut: asyncio.Future):
+        # Failed refinements are not cached (this also marks the exception as retrieved)
+        if fut.cancelled() or fut.exception() is not None:
+            if self._phi_cache.get(key) is fut:
+                del self._phi_cache[key]
+
+    async def _refine(self, text: str) -> str:
+        """Phi-3.5 refinement through the router cache."""
+        key = text.strip().lower()
+        self._phi_waiters[key] = self._phi_waiters.get(key, 0) + 1
+        try:
+            # Shield so one cancelled request doesn't cancel the call other requests share
+            return await asyncio.shield(self._start_refine(text))
+        finally:
+            self._phi_waiters[key] -= 1
+            if not self._phi_waiters[key]:
+                del self._phi_waiters[key]
+
+    def _drop_refine(self, text: str):
+        """Cancel a speculative refinement that turned out not to be needed, unless awaited."""
+        key = text.strip().lower()
+        fut = self._phi_cache.get(key)
+        if fut is not None and not fut.done() and key not in self._phi_waiters:
+            del self._phi_cache[key]
+            fut.cancel()
 
     @app.get("/health")
     async def health(self):
@@ -82,7 +176,7 @@ class RouterDeployment:
     @app.post("/geoNLI/eval")
     async def evaluate(self, request: Request):
         try:
-            body = await request.json()
+            body = orjson.loads(await request.body())
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid JSON body")
 
@@ -94,17 +188,14 @@ class RouterDeployment:
         if image_url:
             try:
                 if image_url.startswith("http"):
-                    # Use a user agent just in case
-                    req = urllib.request.Request(
-                        image_url, 
-                        data=None, 
-                        headers={'User-Agent': 'Mozilla/5.0'}
-                    )
-                    with urllib.request.urlopen(req) as url:
-                        f = io.BytesIO(url.read())
-                        img = Image.open(f).convert("RGB")
+                    # Pooled keep-alive session (sends a user agent just in case)
+                    session = self._get_http_session()
+                    async with session.get(image_url) as resp:
+                        resp.raise_for_status()
+                        data = await resp.read()
+                    img = await asyncio.to_thread(decode_image_bytes, data)
                 elif os.path.exists(image_url):
-                    img = Image.open(image_url).convert("RGB")
+                    img = await asyncio.to_thread(load_image_file, image_url)
                 else:
                     raise ValueError(f"Could not load image from {image_url}")
             except Exception as e:
@@ -112,7 +203,8 @@ class RouterDeployment:
         else:
              raise HTTPException(status_code=400, detail="Missing image_url in input_image")
 
-        frames = [img]
+        # Decoded frames go into the object store once and every task shares the ref
+        frames = ray.put([img])
         queries = body.get("queries", {})
         
         # Get GSD (Ground Sample Distance) from metadata for area calculation
@@ -121,6 +213,7 @@ class RouterDeployment:
         
         # Launch tasks in parallel
         tasks = {}
+        sam_prompts = {}  # RemoteSAM task key -> prompt awaiting Phi-3.5 refinement
         area_query_detected = False  # Flag to track if numeric query is an area query
         
         # Caption
@@ -132,11 +225,8 @@ class RouterDeployment:
             
         # Grounding
         if "grounding_query" in queries:
-            instr = queries["grounding_query"].get("instruction", "")
-            # Refine prompt using Phi-3.5 before passing to RemoteSAM
-            if self.phi:
-                instr = await self.phi.refine_prompt.remote(instr)
-            tasks["grounding"] = self.remotesam.predict.remote(instr, frames)
+            # RemoteSAM prompts are refined together below, after EarthMind tasks are launched
+            sam_prompts["grounding"] = queries["grounding_query"].get("instruction", "")
             
         # Attributes
         attr_query = queries.get("attribute_query", {})
@@ -150,11 +240,7 @@ class RouterDeployment:
             # Check if the query contains "area" - route to RemoteSAM for segmentation-based area calculation
             if "area" in instr.lower():
                 area_query_detected = True
-                # Refine prompt using Phi-3.5 before passing to RemoteSAM
-                refined_instr = instr
-                if self.phi:
-                    refined_instr = await self.phi.refine_prompt.remote(instr)
-                tasks["numeric_area"] = self.remotesam.predict.remote(refined_instr, frames)
+                sam_prompts["numeric_area"] = instr
             else:
                 # Add strict numeric constraint to prompt
                 instr = f"{instr} Answer with only a numeric value, nothing else."
@@ -165,10 +251,20 @@ class RouterDeployment:
             instr = f"{instr} Answer in only 1 to 5 words, nothing more."
             tasks["semantic"] = self.earthmind.predict.remote(instr, frames)
             
-        # Await all results
-        results = {}
-        for key, ref in tasks.items():
-            results[key] = await ref
+        # Refine all RemoteSAM prompts concurrently using Phi-3.5, then dispatch them
+        if sam_prompts:
+            if self.phi:
+                refined = await asyncio.gather(*(self._refine(p) for p in sam_prompts.values()))
+                sam_prompts = dict(zip(sam_prompts, refined))
+            for key, prompt in sam_prompts.items():
+                if key == "numeric_area":
+                    # Area is computed next to the mask; only the number comes back
+                    tasks[key] = self.remotesam.predict.remote(prompt, frames, compute_area=True, gsd=gsd, return_mask=False)
+                else:
+                    tasks[key] = self.remotesam.predict.remote(prompt, frames)
+            
+        # Await all results concurrently
+        results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
             
         # Construct Response
         response = body
@@ -194,28 +290,14 @@ class RouterDeployment:
                 raw_response = results["numeric"].get("prediction", "")
                 response["queries"]["attribute_query"]["numeric"]["response"] = parse_numeric_response(raw_response)
             if "numeric_area" in results:
-                # Calculate area from segmentation mask
-                mask_b64 = results["numeric_area"].get("mask", "")
-                if mask_b64:
-                    try:
-                        # Decode base64 mask to numpy array
-                        mask_bytes = base64.b64decode(mask_b64)
-                        mask_img = Image.open(io.BytesIO(mask_bytes))
-                        mask_np = np.array(mask_img)
-                        
-                        # Calculate area using GSD
-                        area = calculate_area_from_mask(mask_np, gsd)
-                        response["queries"]["attribute_query"]["numeric"]["response"] = float(area)
-                    except Exception as e:
-                        print(f"Error calculating area from mask: {e}")
-                        response["queries"]["attribute_query"]["numeric"]["response"] = 0.0
-                else:
-                    response["queries"]["attribute_query"]["numeric"]["response"] = 0.0
+                # Area computed by RemoteSAM from the segmentation mask and GSD
+                area = results["numeric_area"].get("area_sq_meters")
+                response["queries"]["attribute_query"]["numeric"]["response"] = float(area) if area is not None else 0.0
             if "semantic" in results:
                 raw_response = results["semantic"].get("prediction", "")
                 response["queries"]["attribute_query"]["semantic"]["response"] = parse_semantic_response(raw_response)
                 
-        return JSONResponse(response)
+        return ORJSONResponse(response)
 
     @app.post("/earthmind")
     async def predict_earthmind(self, request: Request):
@@ -225,6 +307,35 @@ class RouterDeployment:
     async def predict_remotesam(self, request: Request):
         return await self.handle_request(request, force_model="remotesam")
 
+    async def Predict(self, request: PredictRequest, grpc_context: RayServegRPCContext) -> PredictResponse:
+        """gRPC ingress (drishti.DrishtiService/Predict): raw image bytes instead of base64 JSON."""
+        if not request.images:
+            grpc_context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            grpc_context.set_details("No images provided.")
+            return PredictResponse()
+        try:
+            frames = await asyncio.gather(*[asyncio.to_thread(decode_image_bytes, data) for data in request.images])
+        except Exception as e:
+            grpc_context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            grpc_context.set_details(f"Failed to decode image: {e}")
+            return PredictResponse()
+
+        try:
+            result = await self._dispatch(request.text, frames, request.select or -1,
+                                          gsd=request.gsd or 1.0, model=request.model or None)
+        except Exception as e:
+            grpc_context.set_code(grpc.StatusCode.INTERNAL)
+            grpc_context.set_details(f"Model execution failed: {e}")
+            return PredictResponse()
+
+        return PredictResponse(
+            prediction=str(result.get("prediction", "")),
+            mask=result.get("mask", ""),
+            obbs=[OrientedBox(coords=box) for box in result.get("obbs", [])],
+            area_sq_meters=result.get("area_sq_meters", 0.0),
+            error=result.get("error", ""),
+        )
+
     async def handle_request(self, request: Request, force_model: str = None):
         """Accepts JSON with either:
         - `images`: list of base64-encoded image strings (frames)
@@ -233,23 +344,23 @@ class RouterDeployment:
         And a `text` field with the prompt. Optionally `select` (1-based index) to select a single frame.
         """
         try:
-            body = await request.json()
+            body = orjson.loads(await request.body())
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid JSON body")
 
         text = body.get("text", "")
         select = int(body.get("select", -1)) if body.get("select") is not None else -1
 
+        # Decoding is CPU-bound, so frames are decoded in worker threads, concurrently
         frames = []
         if "images" in body and isinstance(body["images"], list):
             try:
-                for b64 in body["images"]:
-                    frames.append(pil_from_base64(b64))
+                frames = await asyncio.gather(*[asyncio.to_thread(image_from_base64, b64) for b64 in body["images"]])
             except ValueError as e:
                 raise HTTPException(status_code=400, detail=str(e))
         elif "image" in body and isinstance(body["image"], str):
             try:
-                frames.append(pil_from_base64(body["image"]))
+                frames.append(await asyncio.to_thread(image_from_base64, body["image"]))
             except ValueError as e:
                 raise HTTPException(status_code=400, detail=str(e))
         elif "image_paths" in body and isinstance(body["image_paths"], list):
@@ -257,7 +368,7 @@ class RouterDeployment:
                 for p in body["image_paths"]:
                     if not os.path.exists(p):
                         raise HTTPException(status_code=400, detail=f"Image path not found: {p}")
-                    frames.append(Image.open(p).convert("RGB"))
+                frames = await asyncio.gather(*[asyncio.to_thread(load_image_file, p) for p in body["image_paths"]])
             except HTTPException:
                 raise
             except Exception as e:
@@ -265,76 +376,97 @@ class RouterDeployment:
         else:
             raise HTTPException(status_code=400, detail="No images provided. Send `images`, `image`, or `image_paths`.")
 
+        try:
+            result = await self._dispatch(text, frames, select, gsd=body.get("gsd", 1.0),
+                                          model=body.get("model"), force_model=force_model)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Model execution failed: {e}")
+
+        return ORJSONResponse(result)
+
+    async def _dispatch(self, text: str, frames: list, select: int = -1, gsd: float = 1.0,
+                        model: str = None, force_model: str = None) -> dict:
+        """Route a decoded request to EarthMind or RemoteSAM (shared by HTTP and gRPC ingress).
+
+        `model` is the client's optional model choice; `force_model` is set by the
+        model-specific endpoints and also bypasses the area-query path.
+        """
+        # Decoded frames go into the object store once; deployments read them zero-copy
+        frames = ray.put(frames)
+        
         # Router Logic
         # Allow forcing model via request for testing
         # Check if query contains "area" keyword for special area calculation
         is_area_query = "area" in text.lower()
-        gsd = body.get("gsd", 1.0)  # Get GSD from request body, default to 1.0
+        
+        # Start Phi-3.5 refinement now unless EarthMind is forced, so it overlaps with
+        # classification; it is cancelled below if the request is not routed to RemoteSAM
+        forced = force_model or (model if model in self.models else None)
+        area_path = is_area_query and not force_model
+        speculative_refine = bool(self.phi) and (area_path or forced != "earthmind")
+        if speculative_refine:
+            self._start_refine(text)
+        
+        # Classify once; the task type drives both model selection and EarthMind preprocessing.
+        # The classifier labels any "area" query as "area", so skip the RPC for those, and
+        # for requests forced to RemoteSAM, which never uses the task type.
+        task_type = None
+        if is_area_query:
+            task_type = "area"
+        elif self.classifier and forced != "remotesam":
+            task_type = await self.classifier.predict.remote(text)
+            logger.debug("Classifier predicted task: %s", task_type)
         
         if force_model:
             selected_model = force_model
-        else:
-            force_model_body = body.get("model")
-            if force_model_body in self.models:
-                selected_model = force_model_body
-            elif is_area_query:
-                # Area queries should use RemoteSAM for segmentation-based calculation
+        elif model in self.models:
+            selected_model = model
+        elif is_area_query:
+            # Area queries should use RemoteSAM for segmentation-based calculation
+            selected_model = "remotesam"
+        elif self.classifier:
+            # Use classifier
+            if task_type in ["caption", "vqa"]:
+                selected_model = "earthmind"
+            elif task_type in ["grounding", "area"]:
                 selected_model = "remotesam"
-            elif self.classifier:
-                # Use classifier
-                task_type = await self.classifier.predict.remote(text)
-                print(f"Classifier predicted task: {task_type}")
-                if task_type in ["caption", "vqa"]:
-                    selected_model = "earthmind"
-                elif task_type in ["grounding", "area"]:
-                    selected_model = "remotesam"
-                else:
-                    selected_model = "earthmind" # Default
             else:
-                # Currently random selection
-                selected_model = random.choice(self.models)
+                selected_model = "earthmind" # Default
+        else:
+            # Least-loaded model on this replica, ties broken randomly
+            selected_model = min(self.models, key=lambda m: (self._inflight[m], random.random()))
 
         # selected_model = "earthmind"
             
-        print(f"Router selected: {selected_model}")
+        logger.debug("Router selected: %s", selected_model)
         
-        # Determine task type for efficient preprocessing
-        task_type = None
-        if self.classifier:
-            task_type = await self.classifier.predict.remote(text)
-            print(f"Task type for preprocessing: {task_type}")
+        if speculative_refine and selected_model == "earthmind" and not area_path:
+            self._drop_refine(text)
         
+        # Single event loop, so plain counters are safe
+        target = "remotesam" if area_path else selected_model
+        self._inflight[target] += 1
         try:
-            if is_area_query and not force_model:
+            if area_path:
                 # Special handling for area queries: use RemoteSAM and calculate area from mask
                 refined_text = text
                 if self.phi:
-                    refined_text = await self.phi.refine_prompt.remote(text)
+                    refined_text = await self._refine(text)
                 # Call RemoteSAM with refined prompt
-                remotesam_result = await self.remotesam.predict.remote(refined_text, frames, select)
-                
-                # Calculate area from segmentation mask
-                mask_b64 = remotesam_result.get("mask", "")
-                if mask_b64:
-                    try:
-                        # Decode base64 mask to numpy array
-                        mask_bytes = base64.b64decode(mask_b64)
-                        mask_img = Image.open(io.BytesIO(mask_bytes))
-                        mask_np = np.array(mask_img)
-                        
-                        # Calculate area using GSD
-                        area = calculate_area_from_mask(mask_np, gsd)
-                        result = {
-                            "prediction": str(area),
-                            "mask": mask_b64,
-                            "area_sq_meters": area,
-                            "gsd_used": gsd
-                        }
-                    except Exception as e:
-                        print(f"Error calculating area from mask: {e}")
-                        result = {"prediction": "0.0", "error": str(e)}
+                remotesam_result = await self.remotesam.predict.remote(
+                    refined_text, frames, select, compute_area=True, gsd=gsd)
+            
+                # Area is calculated from the segmentation mask inside RemoteSAM
+                area = remotesam_result.get("area_sq_meters")
+                if area is not None:
+                    result = {
+                        "prediction": str(area),
+                        "mask": remotesam_result.get("mask", ""),
+                        "area_sq_meters": area,
+                        "gsd_used": gsd
+                    }
                 else:
-                    result = {"prediction": "0.0", "error": "No mask returned from segmentation"}
+                    result = {"prediction": "0.0", "error": remotesam_result.get("error", "No mask returned from segmentation")}
             elif selected_model == "earthmind":
                 # Call EarthMind with task_type
                 result = await self.earthmind.predict.remote(text, frames, select, task_type)
@@ -342,10 +474,10 @@ class RouterDeployment:
                 # Refine prompt using Phi-3.5 before passing to RemoteSAM
                 refined_text = text
                 if self.phi:
-                    refined_text = await self.phi.refine_prompt.remote(text)
+                    refined_text = await self._refine(text)
                 # Call RemoteSAM with refined prompt
                 result = await self.remotesam.predict.remote(refined_text, frames, select)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Model execution failed: {e}")
+        finally:
+            self._inflight[target] -= 1
 
-        return JSONResponse(result)
+        return result
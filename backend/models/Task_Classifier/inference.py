@@ -4,7 +4,9 @@ import os
 import torch
 import joblib
 import numpy as np
-from transformers import BertTokenizer, BertModel
+from transformers import BertTokenizerFast, BertModel
+
+MAX_QUERY_TOKENS = 32  # Queries are short sentences; caps attention cost per forward
 
 
 class EndpointHandler:
@@ -17,11 +19,11 @@ class EndpointHandler:
 
     Output:
         For single input:
-            {"label": "...", "confidence": 0.95}
+            {"label": "..."}
         For multiple:
             [
-                {"label": "...", "confidence": 0.95},
-                {"label": "...", "confidence": 0.80},
+                {"label": "..."},
+                {"label": "..."},
                 ...
             ]
     """
@@ -31,10 +33,13 @@ class EndpointHandler:
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"[handler] Using device: {self.device}")
 
-        # 2. Load BERT
+        # 2. Load BERT (fast tokenizer encodes batches in parallel)
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
         print("[handler] Loading BERT tokenizer and model...")
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.bert_model = BertModel.from_pretrained("bert-base-uncased")
+        self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+        # fp16 on GPU (tensor cores); CLS embeddings are cast back to fp32 for the scaler
+        dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+        self.bert_model = BertModel.from_pretrained("bert-base-uncased", torch_dtype=dtype)
         self.bert_model.to(self.device)
         self.bert_model.eval()
 
@@ -47,25 +52,42 @@ class EndpointHandler:
         self.mlp = joblib.load(mlp_path)
         self.scaler = joblib.load(scaler_path)
         self.le = joblib.load(le_path)
+        self.labels = self.le.classes_
+
+        # Fold the scaler into the first MLP layer so embeddings go straight into mlp.predict
+        self._fuse_scaler()
 
         print("[handler] Loaded MLP, scaler, and label encoder.")
 
+    def _fuse_scaler(self):
+        # ((x - mean) / scale) @ W0 + b0 == x @ (W0 / scale) + (b0 - (mean / scale) @ W0)
+        W0 = self.mlp.coefs_[0]
+        b0 = self.mlp.intercepts_[0]
+        n_features = W0.shape[0]
+        # mean_ is fitted even with with_mean=False, so honour the flags like StandardScaler.transform
+        mean = self.scaler.mean_ if getattr(self.scaler, "with_mean", True) else np.zeros(n_features)
+        scale = self.scaler.scale_ if getattr(self.scaler, "with_std", True) else np.ones(n_features)
+
+        scale_inv = 1.0 / scale
+        self.mlp.coefs_[0] = W0 * scale_inv[:, None]
+        self.mlp.intercepts_[0] = b0 - (mean * scale_inv) @ W0
+
     # ------------ Helper: BERT embeddings ------------
     def get_bert_embeddings(self, text_list):
         inputs = self.tokenizer(
             text_list,
             padding=True,
             truncation=True,
-            max_length=128,
+            max_length=MAX_QUERY_TOKENS,
             return_tensors="pt"
         ).to(self.device)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.bert_model(**inputs)
 
         # CLS token embedding
         cls_embeddings = outputs.last_hidden_state[:, 0, :]
-        return cls_embeddings.cpu().numpy()
+        return cls_embeddings.float().cpu().numpy()
 
     # ------------ Main entry point ------------
     def __call__(self, data):
@@ -86,27 +108,12 @@ class EndpointHandler:
         # 1) BERT embedding
         embeddings = self.get_bert_embeddings(texts)
 
-        # 2) Scale with same scaler as training
-        embeddings_scaled = self.scaler.transform(embeddings)
-
-        # 3) Predict class indices
-        pred_indices = self.mlp.predict(embeddings_scaled)
-
-        # 4) Map indices to labels
-        labels = self.le.inverse_transform(pred_indices)
-
-        # 5) Optionally, get probabilities
-        results = []
-        for i, idx in enumerate(pred_indices):
-            label = labels[i]
-            try:
-                probs = self.mlp.predict_proba(embeddings_scaled[i : i + 1])[0]
-                confidence = float(np.max(probs))
-            except Exception:
-                confidence = None
+        # 2) Predict class indices (scaler is fused into the first layer)
+        pred_indices = self.mlp.predict(embeddings)
 
-            result = {"label": label}
-            results.append(result)
+        # 3) Map indices to labels
+        labels = self.labels[pred_indices]
+        results = [{"label": label} for label in labels]
 
         # If the user sent a single string, return a single dict
         if is_single:
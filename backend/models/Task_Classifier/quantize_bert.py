@@ -0,0 +1,39 @@
+# quantize_bert.py
+#
+# Build-time helper: export bert-base-uncased to ONNX and dynamically quantize
+# it to INT8 (AVX512-VNNI) for the CPU path of TaskClassifierDeployment.
+#
+# The MLP head was trained on bert-base-uncased CLS embeddings, so the same
+# encoder is exported here rather than a distilled one.
+#
+# Requires: pip install "optimum[onnxruntime]"
+#
+# Usage:
+#   python quantize_bert.py --output_dir ./bert_onnx
+
+import argparse
+
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export and INT8-quantize BERT for the task classifier")
+    parser.add_argument("--model_id", default="bert-base-uncased")
+    parser.add_argument("--output_dir", default="./bert_onnx")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print(f"[quantize] Exporting {args.model_id} to ONNX...")
+    model = ORTModelForFeatureExtraction.from_pretrained(args.model_id, export=True)
+    model.save_pretrained(args.output_dir)
+
+    print("[quantize] Applying dynamic INT8 quantization (AVX512-VNNI)...")
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=args.output_dir, quantization_config=qconfig)
+
+    print(f"[quantize] Wrote {args.output_dir}/model_quantized.onnx")
@@ -0,0 +1,51 @@
+# train_hash_lr.py
+#
+# Build-time helper: train a BERT-free query router (character n-gram hashing +
+# logistic regression) for TaskClassifierDeployment. When hash_lr.joblib is
+# present next to this script, the deployment uses it instead of BERT + MLP.
+#
+# The training CSV needs a "text" column and a "label" column with the same
+# labels as label_encoder_query_classifier.joblib (e.g. captioning/vqa/grounding).
+#
+# Usage:
+#   python train_hash_lr.py --data queries.csv --output hash_lr.joblib
+
+import argparse
+
+import joblib
+import pandas as pd
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the hashing + logistic regression task classifier")
+    parser.add_argument("--data", required=True, help="CSV with 'text' and 'label' columns")
+    parser.add_argument("--output", default="./hash_lr.joblib")
+    parser.add_argument("--n_features", type=int, default=2 ** 14)
+    parser.add_argument("--test_size", type=float, default=0.1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    df = pd.read_csv(args.data)
+    texts = df["text"].astype(str).str.strip().tolist()
+    labels = df["label"].astype(str).tolist()
+    X_train, X_test, y_train, y_test = train_test_split(
+        texts, labels, test_size=args.test_size, stratify=labels, random_state=0
+    )
+
+    pipe = Pipeline([
+        ("vec", HashingVectorizer(n_features=args.n_features, analyzer="char_wb", ngram_range=(3, 5))),
+        ("clf", LogisticRegression(max_iter=200)),
+    ])
+    print(f"[hash_lr] Training on {len(X_train)} queries...")
+    pipe.fit(X_train, y_train)
+    print(f"[hash_lr] Held-out accuracy: {pipe.score(X_test, y_test):.4f}")
+
+    joblib.dump(pipe, args.output)
+    print(f"[hash_lr] Wrote {args.output}")
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# NO CHECKED-IN PROTOBUF GENCODE
+# source: protos/drishti.proto
+# Protobuf Python Version: 6.31.1
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import runtime_version as _runtime_version
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+_runtime_version.ValidateProtobufRuntimeVersion(
+    _runtime_version.Domain.PUBLIC,
+    6,
+    31,
+    1,
+    '',
+    'protos/drishti.proto'
+)
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x14protos/drishti.proto\x12\x07\x64rishti\"Z\n\x0ePredictRequest\x12\x0e\n\x06images\x18\x01 \x03(\x0c\x12\x0c\n\x04text\x18\x02 \x01(\t\x12\x0e\n\x06select\x18\x03 \x01(\x05\x12\x0b\n\x03gsd\x18\x04 \x01(\x02\x12\r\n\x05model\x18\x05 \x01(\t\"\x1d\n\x0bOrientedBox\x12\x0e\n\x06\x63oords\x18\x01 \x03(\x02\"~\n\x0fPredictResponse\x12\x12\n\nprediction\x18\x01 \x01(\t\x12\x0c\n\x04mask\x18\x02 \x01(\t\x12\"\n\x04obbs\x18\x03 \x03(\x0b\x32\x14.drishti.OrientedBox\x12\x16\n\x0e\x61rea_sq_meters\x18\x04 \x01(\x01\x12\r\n\x05\x65rror\x18\x05 \x01(\t2N\n\x0e\x44rishtiService\x12<\n\x07Predict\x12\x17.drishti.PredictRequest\x1a\x18.drishti.PredictResponseb\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'protos.drishti_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  DESCRIPTOR._loaded_options = None
+  _globals['_PREDICTREQUEST']._serialized_start=33
+  _globals['_PREDICTREQUEST']._serialized_end=123
+  _globals['_ORIENTEDBOX']._serialized_start=125
+  _globals['_ORIENTEDBOX']._serialized_end=154
+  _globals['_PREDICTRESPONSE']._serialized_start=156
+  _globals['_PREDICTRESPONSE']._serialized_end=282
+  _globals['_DRISHTISERVICE']._serialized_start=284
+  _globals['_DRISHTISERVICE']._serialized_end=362
+# @@protoc_insertion_point(module_scope)
@@ -24,10 +24,13 @@ def parse_args():
     parser.add_argument("--remotesam_path", default="./models/RemoteSAM/pretrained_weights/RemoteSAMv1.pth")
     parser.add_argument("--classifier_path", default="./models/Task_Classifier", help="Path to the task classifier model directory")
     parser.add_argument("--phi_model", default="microsoft/Phi-3.5-mini-instruct", help="Phi-3.5 model ID for prompt refinement")
+    parser.add_argument("--phi_draft_model", default=None, help="Optional small draft model ID for Phi-3.5 assisted decoding (e.g. Qwen/Qwen2.5-0.5B-Instruct)")
     parser.add_argument("--host", default="0.0.0.0")
     parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--grpc_port", type=int, default=9000, help="gRPC ingress port (see protos/drishti.proto)")
     parser.add_argument("--load_8bit", action="store_true")
-    parser.add_argument("--dtype", type=str, default="float16", choices=["auto", "float16", "bfloat16", "float32"], help="Model precision")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["auto", "float16", "bfloat16", "float32"], help="Model precision")
+    parser.add_argument("--compile", action="store_true", help="Enable torch.compile for the EarthMind language model")
     parser.add_argument("--no_ray_init", action="store_true", help="Do not call ray.init() (useful if ray already initialized)")
     parser.add_argument("--ray_temp_dir", type=str, default=None, help="Directory for Ray temporary files")
     return parser.parse_args()
@@ -72,6 +75,9 @@ if __name__ == "__main__":
                 allow_headers=["*"],
             )
         ]
+    }, grpc_options={
+        "port": args.grpc_port,
+        "grpc_servicer_functions": ["protos.drishti_pb2_grpc.add_DrishtiServiceServicer_to_server"],
     })
 
     print(f"Deploying EarthMind with {earthmind_gpus} GPUs...")
@@ -79,7 +85,7 @@ if __name__ == "__main__":
         num_replicas=1, 
         ray_actor_options={"num_gpus": earthmind_gpus},
         name="earthmind"
-    ).bind(model_path=args.earthmind_path, load_8bit=args.load_8bit, dtype=args.dtype)
+    ).bind(model_path=args.earthmind_path, load_8bit=args.load_8bit, dtype=args.dtype, compile=args.compile)
     
     # We need to start the deployment to get a handle, but .bind() returns a bound deployment.
     # In Ray Serve 2.0+, we compose them.
@@ -98,9 +104,13 @@ if __name__ == "__main__":
     ).bind(checkpoint_path=args.remotesam_path)
 
     print(f"Deploying Task Classifier...")
-    # Run classifier on CPU to save GPU memory for main models, or use small fraction if needed
+    # Run classifier on CPU to save GPU memory for main models, or use small fraction if needed.
+    # Being CPU-only, it can scale out across cores with request load.
     classifier_deployment = TaskClassifierDeployment.options(
-        num_replicas=1,
+        autoscaling_config={
+            "min_replicas": 1,
+            "max_replicas": max(2, (os.cpu_count() or 1) // 2),
+        },
         ray_actor_options={"num_gpus": 0}, 
         name="classifier"
     ).bind(model_path=args.classifier_path)
@@ -110,11 +120,18 @@ if __name__ == "__main__":
         num_replicas=1,
         ray_actor_options={"num_gpus": phi_gpus},
         name="phi"
-    ).bind(model_id=args.phi_model)
+    ).bind(model_id=args.phi_model, draft_model_id=args.phi_draft_model)
 
     print("Deploying Router...")
+    # The router only does I/O, JSON and image decoding, so run several replicas and let each
+    # handle many concurrent requests while it awaits the model deployments
     router_deployment = RouterDeployment.options(
-        num_replicas=1,
+        autoscaling_config={
+            "min_replicas": 2,
+            "max_replicas": 8,
+            "target_ongoing_requests": 5,
+        },
+        max_ongoing_requests=16,
         name="router"
     ).bind(earthmind_handle=earthmind_deployment, remotesam_handle=remotesam_deployment, classifier_handle=classifier_deployment, phi_handle=phi_deployment)
 
@@ -122,6 +139,7 @@ if __name__ == "__main__":
 
     # Ray Serve will expose the FastAPI app. We print the route for convenience.
     print(f"EarthMind Ray Serve deployment 'earthmind_app' started at http://{args.host}:{args.port}/predict")
+    print(f"gRPC ingress (drishti.DrishtiService/Predict) listening on port {args.grpc_port}")
 
     try:
         import time
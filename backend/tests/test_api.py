@@ -3,13 +3,27 @@
 Test script for the /geoNLI/eval endpoint.
 """
 
+import copy
+import os
 import requests
 import json
 import sys
+import time
+from jsonschema import Draft202012Validator
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # API endpoint
 API_URL = "http://localhost:8000/geoNLI/eval"
 
+# Shared session: keep-alive connections are reused across requests
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20,
+                       max_retries=Retry(connect=3, backoff_factor=0.5))
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"Content-Type": "application/json"})
+
 # Test payload
 test_payload = {
     "input_image": {
@@ -43,103 +57,76 @@ test_payload = {
 }
 
 
-def validate_response_format(result: dict) -> tuple[bool, list[str]]:
+def _query(response_schema: dict) -> dict:
+    """Schema for a query block: an instruction plus the model's response."""
+    return {
+        "type": "object",
+        "required": ["instruction", "response"],
+        "properties": {"response": response_schema},
+    }
+
+
+# Expected /geoNLI/eval response format
+RESPONSE_SCHEMA = {
+    "$schema": "https://json-schema.org/draft/2020-12/schema",
+    "type": "object",
+    "required": ["input_image", "queries"],
+    "properties": {
+        "input_image": {
+            "type": "object",
+            "required": ["image_id", "image_url", "metadata"],
+            "properties": {
+                "metadata": {
+                    "type": "object",
+                    "required": ["width", "height", "spatial_resolution_m"],
+                },
+            },
+        },
+        "queries": {
+            "type": "object",
+            "properties": {
+                "caption_query": _query({"type": "string"}),
+                "grounding_query": _query({
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["object-id", "obbox"],
+                        "properties": {"obbox": {"type": "array"}},
+                    },
+                }),
+                "attribute_query": {
+                    "type": "object",
+                    "properties": {
+                        "binary": _query({"type": "string", "enum": ["Yes", "No"]}),
+                        "numeric": _query({"type": "number"}),
+                        "semantic": _query({"type": "string"}),
+                    },
+                },
+            },
+        },
+    },
+}
+
+# Same envelope, but grounding responses are only checked to be lists (no per-OBB checks)
+ENVELOPE_SCHEMA = copy.deepcopy(RESPONSE_SCHEMA)
+del ENVELOPE_SCHEMA["properties"]["queries"]["properties"]["grounding_query"]["properties"]["response"]["items"]
+
+# Built once; reused for every response
+VALIDATOR = Draft202012Validator(RESPONSE_SCHEMA)
+ENVELOPE_VALIDATOR = Draft202012Validator(ENVELOPE_SCHEMA)
+
+# Set DRISHTI_DEEP_VALIDATE=0 to skip per-object validation of large grounding responses
+DEEP_VALIDATE = os.getenv("DRISHTI_DEEP_VALIDATE", "1") == "1"
+
+
+def validate_response_format(result: dict, deep: bool = True) -> tuple[bool, list[str]]:
     """
     Validate that the response matches the expected format.
+    With deep=False, grounding response items are not validated individually.
     Returns (is_valid, list of errors).
     """
-    errors = []
-    
-    # Check top-level structure
-    if "input_image" not in result:
-        errors.append("Missing 'input_image' in response")
-    else:
-        input_image = result["input_image"]
-        if "image_id" not in input_image:
-            errors.append("Missing 'input_image.image_id'")
-        if "image_url" not in input_image:
-            errors.append("Missing 'input_image.image_url'")
-        if "metadata" not in input_image:
-            errors.append("Missing 'input_image.metadata'")
-        else:
-            metadata = input_image["metadata"]
-            for field in ["width", "height", "spatial_resolution_m"]:
-                if field not in metadata:
-                    errors.append(f"Missing 'input_image.metadata.{field}'")
-    
-    if "queries" not in result:
-        errors.append("Missing 'queries' in response")
-        return len(errors) == 0, errors
-    
-    queries = result["queries"]
-    
-    # Validate caption_query
-    if "caption_query" in queries:
-        cq = queries["caption_query"]
-        if "instruction" not in cq:
-            errors.append("Missing 'queries.caption_query.instruction'")
-        if "response" not in cq:
-            errors.append("Missing 'queries.caption_query.response'")
-        elif not isinstance(cq["response"], str):
-            errors.append(f"'queries.caption_query.response' should be string, got {type(cq['response']).__name__}")
-    
-    # Validate grounding_query
-    if "grounding_query" in queries:
-        gq = queries["grounding_query"]
-        if "instruction" not in gq:
-            errors.append("Missing 'queries.grounding_query.instruction'")
-        if "response" not in gq:
-            errors.append("Missing 'queries.grounding_query.response'")
-        elif not isinstance(gq["response"], list):
-            errors.append(f"'queries.grounding_query.response' should be list, got {type(gq['response']).__name__}")
-        else:
-            for idx, obj in enumerate(gq["response"]):
-                if not isinstance(obj, dict):
-                    errors.append(f"'queries.grounding_query.response[{idx}]' should be dict")
-                    continue
-                if "object-id" not in obj:
-                    errors.append(f"Missing 'object-id' in grounding response[{idx}]")
-                if "obbox" not in obj:
-                    errors.append(f"Missing 'obbox' in grounding response[{idx}]")
-                elif not isinstance(obj["obbox"], list):
-                    errors.append(f"'obbox' in grounding response[{idx}] should be list")
-    
-    # Validate attribute_query
-    if "attribute_query" in queries:
-        aq = queries["attribute_query"]
-        
-        # Binary
-        if "binary" in aq:
-            binary = aq["binary"]
-            if "instruction" not in binary:
-                errors.append("Missing 'queries.attribute_query.binary.instruction'")
-            if "response" not in binary:
-                errors.append("Missing 'queries.attribute_query.binary.response'")
-            elif not isinstance(binary["response"], str):
-                errors.append(f"'queries.attribute_query.binary.response' should be string, got {type(binary['response']).__name__}")
-            elif binary["response"] not in ["Yes", "No"]:
-                errors.append(f"'queries.attribute_query.binary.response' should be 'Yes' or 'No', got '{binary['response']}'")
-        
-        # Numeric
-        if "numeric" in aq:
-            numeric = aq["numeric"]
-            if "instruction" not in numeric:
-                errors.append("Missing 'queries.attribute_query.numeric.instruction'")
-            if "response" not in numeric:
-                errors.append("Missing 'queries.attribute_query.numeric.response'")
-            elif not isinstance(numeric["response"], (int, float)):
-                errors.append(f"'queries.attribute_query.numeric.response' should be number, got {type(numeric['response']).__name__}")
-        
-        # Semantic
-        if "semantic" in aq:
-            semantic = aq["semantic"]
-            if "instruction" not in semantic:
-                errors.append("Missing 'queries.attribute_query.semantic.instruction'")
-            if "response" not in semantic:
-                errors.append("Missing 'queries.attribute_query.semantic.response'")
-            elif not isinstance(semantic["response"], str):
-                errors.append(f"'queries.attribute_query.semantic.response' should be string, got {type(semantic['response']).__name__}")
-    
+    validator = VALIDATOR if deep else ENVELOPE_VALIDATOR
+    errors = [f"{e.json_path}: {e.message}" for e in validator.iter_errors(result)]
     return len(errors) == 0, errors
 
 
@@ -153,10 +140,9 @@ def test_evaluate():
     print("\n" + "-" * 60)
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             API_URL,
             json=test_payload,
-            headers={"Content-Type": "application/json"},
             timeout=300  # 5 minute timeout for model inference
         )
         
@@ -172,7 +158,10 @@ def test_evaluate():
             print("RESPONSE FORMAT VALIDATION")
             print("=" * 60)
             
-            is_valid, errors = validate_response_format(result)
+            start = time.perf_counter()
+            is_valid, errors = validate_response_format(result, deep=DEEP_VALIDATE)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            print(f"\nValidated in {elapsed_ms:.2f} ms ({'deep' if DEEP_VALIDATE else 'envelope only'})")
             
             if is_valid:
                 print("\n✅ Response format is valid!")
@@ -231,5 +220,8 @@ def test_evaluate():
 
 
 if __name__ == "__main__":
-    exit_code = test_evaluate()
+    try:
+        exit_code = test_evaluate()
+    finally:
+        SESSION.close()
     sys.exit(exit_code)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Tests for the regex grounding-prompt rewriter tried before Phi-3.5.
+"""
+
+import pytest
+
+from utils_pkg.prompt_refiner import RegexRefiner
+
+# The EXAMPLES in SYSTEM_INSTRUCTION (deployments/phi_deployment.py); None means the
+# rewriter defers to the LLM
+SYSTEM_INSTRUCTION_EXAMPLES = [
+    ("Locate and return oriented bounding boxes for the aircrafts seen in the image.", "aircrafts"),
+    ("Find the bounding box of the truck on the top left.", "truck on the top left"),
+    ("Bounding box of vehicle located at the top-most position in the provided image.",
+     "vehicle at the top-most position"),
+    ("The bottom-most harbor in the image has a platform extending into the water and is closer "
+     "to the bottom edge of the image.", None),
+    ("What is the orientation of the road in the image?", None),
+    ("give me the bounding box of the stadium in the image", "stadium"),
+]
+
+# Prompts the rules used to rewrite wrongly instead of deferring
+REWRITE_CASES = [
+    ("Highlight the airport", "airport"),
+    ("Outline the swimming pool in the image.", "swimming pool"),
+    ("Point out the bridge", "bridge"),
+    ("Find one of the ships.", "ship"),
+    ("Find a ship at the coast of the image", None),
+    ("locate the road in the image of the city", None),
+    ("Calculate the area of the buildings", None),
+    ("find one of the buses near the road", None),
+    ("Find the tennis court. Return its mask.", None),
+    ("Count the storage tanks", None),
+]
+
+
+@pytest.fixture(scope="module")
+def refiner():
+    return RegexRefiner()
+
+
+@pytest.mark.parametrize("query, expected", SYSTEM_INSTRUCTION_EXAMPLES + REWRITE_CASES)
+def test_refine(refiner, query, expected):
+    assert refiner.refine(query) == expected
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Regression tests for the mask helpers in utils_pkg.utils.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from utils_pkg.utils import get_cleaned_obbs
+
+
+def _watershed_obbs(mask: np.ndarray) -> list:
+    """Reference OBBs: the original watershed pipeline, one full-image contour pass per label."""
+    height, width = mask.shape
+    kernel = np.ones((3, 3), np.uint8)
+    opening = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=2)
+    sure_bg = cv2.dilate(opening, kernel, iterations=3)
+    dist_transform = cv2.distanceTransform(opening, cv2.DIST_L2, 5)
+    _, sure_fg = cv2.threshold(dist_transform, 0.2 * dist_transform.max(), 255, 0)
+    sure_fg = np.uint8(sure_fg)
+    unknown = cv2.subtract(sure_bg, sure_fg)
+    _, markers = cv2.connectedComponents(sure_fg)
+    markers = markers + 1
+    markers[unknown == 255] = 0
+    markers = cv2.watershed(cv2.cvtColor(opening, cv2.COLOR_GRAY2BGR), markers)
+
+    contours = []
+    for label in np.unique(markers):
+        if label <= 1:
+            continue
+        found, _ = cv2.findContours((markers == label).astype(np.uint8) * 255,
+                                    cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if found:
+            contours.append(max(found, key=cv2.contourArea))
+
+    areas = [cv2.contourArea(c) for c in contours]
+    threshold = 0.25 * np.mean(areas)
+    obbs = []
+    for c, area in zip(contours, areas):
+        if area >= threshold:
+            box = cv2.boxPoints(cv2.minAreaRect(c))
+            obbs.append([float(v) for x, y in box for v in (x / width, y / height)])
+    return obbs
+
+
+def _ellipse_mask(shape, center, axes, angle) -> np.ndarray:
+    mask = np.zeros(shape, np.uint8)
+    cv2.ellipse(mask, center, axes, angle, 0, 360, 255, -1)
+    return mask
+
+
+@pytest.mark.parametrize("center, axes, angle", [
+    ((60, 50), (30, 12), 0.0),
+    ((80, 70), (25, 18), 33.0),
+    ((100, 60), (40, 9), 117.5),
+    ((64, 64), (20, 20), 0.0),
+])
+def test_single_blob_matches_watershed(center, axes, angle):
+    mask = _ellipse_mask((128, 160), center, axes, angle)
+    obbs = get_cleaned_obbs(mask)
+    assert len(obbs) == 1
+    assert obbs[0] == pytest.approx(_watershed_obbs(mask)[0], abs=1e-6)
+
+
+def test_touching_blobs_match_watershed():
+    # Two discs joined by a thin bridge: one raw component, two watershed seeds
+    mask = _ellipse_mask((128, 160), (45, 64), (25, 25), 0.0)
+    mask |= _ellipse_mask((128, 160), (115, 64), (25, 25), 0.0)
+    mask[60:68, 45:115] = 255
+    expected = _watershed_obbs(mask)
+    obbs = get_cleaned_obbs(mask)
+    assert len(obbs) == len(expected) == 2
+    for box, ref in zip(obbs, expected):
+        assert box == pytest.approx(ref, abs=1e-6)
+
+
+def test_random_single_blobs_match_watershed():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        center = (int(rng.integers(40, 120)), int(rng.integers(40, 90)))
+        axes = (int(rng.integers(6, 35)), int(rng.integers(6, 35)))
+        mask = _ellipse_mask((128, 160), center, axes, float(rng.uniform(0, 180)))
+        expected = _watershed_obbs(mask)
+        obbs = get_cleaned_obbs(mask)
+        assert len(obbs) == len(expected)
+        for box, ref in zip(obbs, expected):
+            assert box == pytest.approx(ref, abs=1e-6)
@@ -1,9 +1,12 @@
-from .utils import mask_to_base64, get_cleaned_obbs, get_seg_hidden_states
+from .utils import mask_to_base64, get_cleaned_obbs, get_seg_hidden_states, resolve_frames
 from .token_pruning import EarthMindEfficientPreprocessor
+from .prompt_refiner import RegexRefiner
 
 __all__ = [
     "mask_to_base64",
     "get_cleaned_obbs",
     "get_seg_hidden_states",
+    "resolve_frames",
     "EarthMindEfficientPreprocessor",
+    "RegexRefiner",
 ]
@@ -0,0 +1,69 @@
+import re
+from typing import Optional
+
+
+class RegexRefiner:
+    """
+    Deterministic rewriter for the Phi "kill list" (see SYSTEM_INSTRUCTION in
+    deployments/phi_deployment.py): strips command verbs, meta-noise and image
+    references from grounding queries without running the LLM.
+
+    refine() returns None when the query is outside what the rules cover
+    (questions, several sentences, leftover command verbs or image references,
+    irregular plurals, empty or overly long results) so the caller can fall back.
+    """
+
+    MAX_WORDS = 12
+
+    _QUESTION = re.compile(r"^(?:what|which|where|how|why|who|is|are|does|do|can|could)\b|\?\s*$")
+    # Only a trailing "in the image" is noise; "coast of the image", "image of the city" carry meaning
+    _IMAGE_REFS = re.compile(
+        r"\s*\b(?:(?:seen|visible|present|shown)\s+(?:in|of)|in)\s+the\s+(?:provided\s+|given\s+)?image$"
+    )
+    _IMAGE_LEFT = re.compile(r"\bimages?\b")
+    _COMMAND = re.compile(
+        r"^(?:please\s+)?(?:locate and return|show me|give me|point out|find|locate|detect|segment|return"
+        r"|highlight|mark|outline|identify|show|draw|indicate)\b\s*"
+    )
+    _META = re.compile(
+        r"\b(?:the\s+)?(?:oriented\s+)?(?:bounding\s+box(?:es)?|coordinates|masks?)\b(?:\s+(?:of|for))?\s*"
+    )
+    _SENTENCE_BREAK = re.compile(r"[.!?;]\s+\S")
+    _LEFTOVER_VERB = re.compile(
+        r"\b(?:calculate|compute|count|measure|estimate|return|find|locate|detect|segment|show|give|identify"
+        r"|highlight|mark|outline|point out|draw|indicate)\b"
+    )
+    _ONE_OF_THE = re.compile(r"\bone of the\s+(\w+)s\b")
+    _IRREGULAR_PLURAL = re.compile(r"(?:s|[sxz]e|[cs]he|ie|u|i)$")  # Stem before the final "s"
+    _FILLER = re.compile(r"\b(?:located|placed)\s+")
+    _ARTICLE = re.compile(r"^(?:the|a|an)\s+")
+    _SPACES = re.compile(r"\s+")
+
+    def refine(self, query: str) -> Optional[str]:
+        text = query.strip().lower()
+        if not text or self._QUESTION.search(text):
+            return None
+
+        text = text.rstrip(" .!")
+        if self._SENTENCE_BREAK.search(text):
+            return None
+        text = self._IMAGE_REFS.sub("", text)
+        text = self._COMMAND.sub("", text)
+        text = self._META.sub("", text)
+
+        # Only plain "-s" plurals are singularized ("buses", "boxes", "ss"/"us"/"is" words go to the LLM)
+        one_of = self._ONE_OF_THE.search(text)
+        if one_of:
+            if self._IRREGULAR_PLURAL.search(one_of.group(1)):
+                return None
+            text = text[:one_of.start()] + one_of.group(1) + text[one_of.end():]
+
+        text = self._FILLER.sub("", text)
+        text = self._SPACES.sub(" ", text).strip(" ,.")
+        text = self._ARTICLE.sub("", text)
+
+        if not text or len(text.split()) > self.MAX_WORDS:
+            return None
+        if self._LEFTOVER_VERB.search(text) or self._IMAGE_LEFT.search(text):
+            return None
+        return text
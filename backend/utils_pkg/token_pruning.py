@@ -1,24 +1,36 @@
+import functools
+from collections import OrderedDict
 import torch
 import numpy as np
+from PIL import Image
 
+INPUT_IDS_CACHE_SIZE = 32  # Max cached (tile shape, prompt) -> input_ids tensors
+ATTENTION_LAYERS = range(19, 30)  # Language-model layers whose attention drives tile selection
 
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
+    # target_ratios: (N, 2) int array of (cols, rows), or a list of tuples
+    ratios = np.asarray(target_ratios)
+    diffs = np.abs(aspect_ratio - ratios[:, 0] / ratios[:, 1])
+    candidates = np.flatnonzero(diffs == diffs.min())
     
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    return best_ratio
+    # Ties go to the first candidate unless a later one is small enough for the image area
+    later = candidates[1:]
+    area = width * height
+    fits = area > 0.5 * image_size * image_size * ratios[later, 0] * ratios[later, 1]
+    best = later[fits][-1] if fits.any() else candidates[0]
+    return int(ratios[best, 0]), int(ratios[best, 1])
+
+@functools.lru_cache(maxsize=16)
+def _build_target_ratios(min_num, max_num):
+    """(cols, rows) tile grids with min_num <= cols * rows <= max_num, sorted by tile count."""
+    ratios = sorted({(i, j)
+                     for n in range(min_num, max_num + 1)
+                     for i in range(1, n + 1) for j in range(1, n + 1)
+                     if i * j <= max_num and i * j >= min_num}, key=lambda x: x[0] * x[1])
+    arr = np.array(ratios, dtype=np.int32)
+    arr.flags.writeable = False  # Shared between callers through the cache
+    return arr
 
 def dynamic_preprocess(image, target_ratios, image_size=448, use_thumbnail=False):
     orig_width, orig_height = image.size
@@ -35,15 +47,10 @@ def dynamic_preprocess(image, target_ratios, image_size=448, use_thumbnail=False
 
     resized_img = image.resize((target_width, target_height))
     
-    processed_images = []
-    w_step = image_size
-    h_step = image_size
-    
-    for i in range(blocks):
-        c = i % cols
-        r = i // cols
-        box = (c * w_step, r * h_step, (c + 1) * w_step, (r + 1) * h_step)
-        processed_images.append(resized_img.crop(box))
+    # (rows, cols, tile, tile[, C]) view of the resized image; tiles in row-major order
+    arr = np.asarray(resized_img)
+    tiles = arr.reshape(rows, image_size, cols, image_size, *arr.shape[2:]).swapaxes(1, 2)
+    processed_images = [Image.fromarray(tiles[i // cols, i % cols]) for i in range(blocks)]
         
     if use_thumbnail and len(processed_images) != 1:
         thumbnail_img = image.resize((image_size, image_size))
@@ -61,30 +68,110 @@ class EarthMindEfficientPreprocessor:
         # Pre-calculate target ratios
         self.min_num = model.min_dynamic_patch
         self.max_num = model.max_dynamic_patch
-        self.target_ratios = sorted({(i, j)
-                         for n in range(self.min_num, self.max_num + 1)
-                         for i in range(1, n + 1) for j in range(1, n + 1)
-                         if i * j <= self.max_num and i * j >= self.min_num}, key=lambda x: x[0] * x[1])
+        self._ratio_arr = _build_target_ratios(self.min_num, self.max_num)
+        self.target_ratios = [tuple(r) for r in self._ratio_arr.tolist()]
+        
+        # LRU of (H, W, prompt) -> input_ids; the tensors are only read, never modified
+        self._ids_cache = OrderedDict()
+        # (rows, cols, device, dtype) -> (neighbor kernel, neighbor count); grids are few
+        self._neighbor_cache = {}
+        
+        # Image tokens are special tokens, so the tokenizer splits around them and the text
+        # ids don't depend on how many context tokens sit between <img> and </img>
+        self._img_start_token_id = tokenizer.convert_tokens_to_ids(model.IMG_START_TOKEN)
+        self._img_context_token_id = tokenizer.convert_tokens_to_ids(model.IMG_CONTEXT_TOKEN)
+        # num_image_tokens -> context id block; token counts are whole tiles (patch_token each),
+        # so build the blocks for every tile count up front (plus the thumbnail)
+        self._context_blocks = {}
+        for n in range(1, self.max_num + 2):
+            self._context_block(n * model.patch_token)
+        
+        # Attention maps of ATTENTION_LAYERS, collected by hooks during the heatmap forward
+        # (only those layers return weights, instead of the model returning all of them)
+        self._captured_attn = None
+        self._attn_hooks = self._install_attention_hooks()
+
+    def _install_attention_hooks(self):
+        try:
+            layers = self.model.language_model.get_decoder().layers
+        except AttributeError:
+            print("Could not locate language model layers; falling back to output_attentions=True.")
+            return False
+        for idx in ATTENTION_LAYERS:
+            attn = layers[idx].self_attn
+            attn.register_forward_pre_hook(self._request_attn_weights, with_kwargs=True)
+            attn.register_forward_hook(self._capture_attn_weights)
+        return True
+
+    def _request_attn_weights(self, module, args, kwargs):
+        if self._captured_attn is not None:
+            kwargs["output_attentions"] = True
+            return args, kwargs
+
+    def _capture_attn_weights(self, module, args, output):
+        if self._captured_attn is not None and output[1] is not None:
+            self._captured_attn.append(output[1])
 
     def _get_input_ids(self, image_tensor, prompt_text):
+        _, _, H, W = image_tensor.shape
+        key = (H, W, prompt_text)
+        ids = self._ids_cache.get(key)
+        if ids is not None:
+            self._ids_cache.move_to_end(key)
+            return ids
+        
         config = self.model.config.vision_config
         patch_size = config.patch_size
         downsample_ratio = self.model.downsample_ratio
         
-        _, _, H, W = image_tensor.shape
-        
         num_image_tokens = int((H // patch_size) * (W // patch_size) * (downsample_ratio ** 2))
         
-        image_token_str = f'{self.model.IMG_START_TOKEN}' \
-                          f'{self.model.IMG_CONTEXT_TOKEN * num_image_tokens}' \
-                          f'{self.model.IMG_END_TOKEN}'
-        
+        ids = self.build_input_ids(prompt_text, num_image_tokens)
+        self._ids_cache[key] = ids
+        if len(self._ids_cache) > INPUT_IDS_CACHE_SIZE:
+            self._ids_cache.popitem(last=False)
+        return ids
+
+    def _get_neighbor_kernel(self, rows, cols, device, dtype):
+        """3x3 neighbor-sum kernel and the (rows, cols) count of valid neighbors (+1e-8), cached."""
+        import torch.nn.functional as F
+        key = (rows, cols, device, dtype)
+        cached = self._neighbor_cache.get(key)
+        if cached is None:
+            kernel = torch.ones(1, 1, 3, 3, device=device, dtype=dtype)
+            kernel[0, 0, 1, 1] = 0
+            # Count of valid neighbors (to handle edges)
+            ones = torch.ones(1, 1, rows, cols, device=device, dtype=dtype)
+            neighbor_count = F.conv2d(ones, kernel, padding=1).view(rows, cols) + 1e-8
+            cached = self._neighbor_cache[key] = (kernel, neighbor_count)
+        return cached
+
+    def build_input_ids(self, prompt_text, num_image_tokens):
+        """Chat-template input_ids (1, L) with each <image> expanded to num_image_tokens context tokens."""
+        image_token_str = f'{self.model.IMG_START_TOKEN}{self.model.IMG_END_TOKEN}'
         text = prompt_text.replace('<image>', image_token_str)
         input_text = self.model.template['INSTRUCTION'].format(
             input=text, round=1, bot_name=self.model.bot_name)
-            
-        ids = self.tokenizer.encode(input_text)
-        return torch.tensor(ids).to(self.device).unsqueeze(0)
+        
+        # Tokenize with empty image blocks, then splice the context block in after each <img>
+        text_ids = torch.tensor(self.tokenizer.encode(input_text))
+        starts = (text_ids == self._img_start_token_id).nonzero(as_tuple=True)[0].tolist()
+        pieces = []
+        prev = 0
+        block = self._context_block(num_image_tokens)
+        for pos in starts:
+            pieces += [text_ids[prev:pos + 1], block]
+            prev = pos + 1
+        pieces.append(text_ids[prev:])
+        return torch.cat(pieces).to(self.device).unsqueeze(0)
+
+    def _context_block(self, num_image_tokens):
+        """Cached CPU tensor of num_image_tokens <IMG_CONTEXT> ids."""
+        block = self._context_blocks.get(num_image_tokens)
+        if block is None:
+            block = torch.full((num_image_tokens,), self._img_context_token_id, dtype=torch.long)
+            self._context_blocks[num_image_tokens] = block
+        return block
 
     def _get_gradient_weighted_attention_map(self, image_tensor, prompt_text):
         import torch.nn.functional as F
@@ -101,19 +188,31 @@ class EarthMindEfficientPreprocessor:
                 'prompt_masks': None
             }
             
-            outputs = self.model(data, output_attentions=True)
+            if self._attn_hooks:
+                self._captured_attn = []
+                try:
+                    self.model(data)
+                    attn_weights_list = self._captured_attn
+                finally:
+                    self._captured_attn = None
+            else:
+                outputs = self.model(data, output_attentions=True)
+                attn_weights_list = outputs.attentions[ATTENTION_LAYERS.start:ATTENTION_LAYERS.stop]
             
             img_token_id = self.model.img_context_token_id
             is_img = (prompt_ids[0] == img_token_id)
-            is_text = ~is_img
-            
-            # Using layers 19 through 29
-            attn_weights_list = outputs.attentions[19:30] 
-            avg_attn = torch.stack(attn_weights_list).mean(dim=0)
+            img_idx = is_img.nonzero(as_tuple=True)[0]
+            text_idx = (~is_img).nonzero(as_tuple=True)[0]
             
-            text_attn = avg_attn[:, :, is_text, :]
-            text_img_attn = text_attn[:, :, :, is_img]
-            heatmap = text_img_attn.mean(dim=(0, 1, 2))
+            # Using layers 19 through 29: average text->image attention per layer straight into
+            # one fp32 (num_img_tokens,) accumulator instead of stacking the full maps
+            heatmap = None
+            for layer_attn in attn_weights_list:
+                # Text rows first (the smaller intermediate), then image columns
+                text_img_attn = layer_attn.index_select(2, text_idx).index_select(3, img_idx)
+                layer_map = text_img_attn.mean(dim=(0, 1, 2), dtype=torch.float32)
+                heatmap = layer_map if heatmap is None else heatmap.add_(layer_map)
+            heatmap = heatmap.div_(len(attn_weights_list))
             
             config = self.model.config.vision_config
             patch_size = config.patch_size
@@ -156,12 +255,13 @@ class EarthMindEfficientPreprocessor:
             print(f"Image area ({image_area}) <= {self.area_threshold}. Skipping pruning (using all tiles).")
         
         # Handle max_tiles override
-        target_ratios = self.target_ratios
+        target_ratios = self._ratio_arr
         if max_tiles is not None:
-             target_ratios = sorted({(i, j)
-                         for n in range(self.min_num, max_tiles + 1)
-                         for i in range(1, n + 1) for j in range(1, n + 1)
-                         if i * j <= max_tiles and i * j >= self.min_num}, key=lambda x: x[0] * x[1])
+            if max_tiles >= self.min_num:
+                target_ratios = _build_target_ratios(self.min_num, max_tiles)
+            else:
+                # No grid fits; same (1, 1) layout an empty ratio list used to give
+                target_ratios = np.array([(1, 1)], dtype=np.int32)
         
         # Determine grid layout
         image_size = self.model.config.vision_config.image_size
@@ -172,8 +272,8 @@ class EarthMindEfficientPreprocessor:
             use_thumbnail=self.model.use_thumbnail
         )
         
-        # If not using pruning, return all tiles
-        if not use_pruning:
+        # If not using pruning, return all tiles; a single tile is always kept anyway
+        if not use_pruning or cols * rows <= 1:
             return processed_images
         
         # Otherwise, proceed with token pruning
@@ -209,41 +309,23 @@ class EarthMindEfficientPreprocessor:
         mask1 = hm_norm > threshold
         
         # Condition 2: Local peak
-        # Use convolution to calculate neighbor averages
-        # Kernel: 3x3 ones with center 0
-        kernel = torch.ones(1, 1, 3, 3, device=self.device, dtype=hm_norm.dtype)
-        kernel[0, 0, 1, 1] = 0
-        
-        hm_input = hm_norm.unsqueeze(0).unsqueeze(0) # (1, 1, rows, cols)
-        
-        # Sum of neighbors
-        neighbor_sum = F.conv2d(hm_input, kernel, padding=1)
+        # Use convolution to calculate neighbor sums (3x3 ones with center 0)
+        kernel, neighbor_count = self._get_neighbor_kernel(rows, cols, hm_norm.device, hm_norm.dtype)
         
-        # Count of valid neighbors (to handle edges)
-        ones = torch.ones_like(hm_input)
-        neighbor_count = F.conv2d(ones, kernel, padding=1)
+        hm_input = hm_norm.view(1, 1, rows, cols)
+        neighbor_sum = F.conv2d(hm_input, kernel, padding=1).view(rows, cols)
         
-        avg_neighbor = neighbor_sum / (neighbor_count + 1e-8)
-        avg_neighbor = avg_neighbor.squeeze()
-        
-        if avg_neighbor.ndim == 0: # Handle 1x1 case
-             avg_neighbor = avg_neighbor.view(1, 1)
-        
-        mask2 = (hm_norm > (avg_neighbor * 1.2)) & (hm_norm > hm_norm.mean())
+        # hm > 1.2 * neighbor_sum / count, without materializing the neighbor average
+        mask2 = (hm_norm * neighbor_count > 1.2 * neighbor_sum) & (hm_norm > hm_norm.mean())
         
         final_mask = mask1 | mask2
         
-        # Get indices
-        flat_mask = final_mask.flatten()
-        selected_indices = torch.nonzero(flat_mask).squeeze(1).tolist()
-        
-        if isinstance(selected_indices, int):
-            selected_indices = [selected_indices]
+        # Get indices (one device -> host copy of the small mask)
+        selected_indices = np.flatnonzero(final_mask.cpu().numpy())
         
         # If no tiles selected, select max
-        if not selected_indices:
-            max_idx = torch.argmax(hm_grid.flatten()).item()
-            selected_indices.append(max_idx)
+        if selected_indices.size == 0:
+            selected_indices = [int(torch.argmax(hm_grid.flatten()).item())]
         
         final_images = [processed_images[idx] for idx in selected_indices]
             
@@ -1,57 +1,77 @@
 import numpy as np
 import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-import io
+
+try:
+    from pycocotools import mask as mask_utils
+except ImportError:
+    mask_utils = None
+
+CONTOUR_PARALLEL_MIN = 4  # Watershed objects needed before contours are traced in a thread pool
+_contour_pool = None  # Created on first use
+
+
+def _mask_to_2d(mask: np.ndarray) -> np.ndarray:
+    # Drop a singleton channel/batch dim; convert RGB masks to grayscale
+    if mask.ndim == 3:
+        if mask.shape[2] == 1:
+            mask = mask[:, :, 0]
+        elif mask.shape[0] == 1:
+            mask = mask[0]
+        elif mask.shape[2] in (3, 4):
+            # Convert RGB to grayscale (OpenCV works in uint8, no float64 temporary)
+            import cv2
+            mask = cv2.cvtColor(np.ascontiguousarray(mask, dtype=np.uint8), cv2.COLOR_RGB2GRAY)
+        else:
+            mask = np.mean(mask, axis=2)
+    return mask
+
+
+def _normalize_mask_uint8(mask: np.ndarray) -> np.ndarray:
+    """2D contiguous uint8 mask; binary (bool or 0/1) masks are scaled to 0/255."""
+    mask = _mask_to_2d(mask)
+    if mask.dtype == bool:
+        mask = mask.view(np.uint8) * np.uint8(255)
+    elif mask.max() <= 1:
+        mask = (mask * 255).astype(np.uint8, copy=False)
+    elif mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+    return np.ascontiguousarray(mask)
+
+
+def _encode_rle(mask: np.ndarray) -> str:
+    # COCO RLE of a 2D binary mask as base64(JSON {"size": [h, w], "counts": str})
+    rle = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    rle["counts"] = rle["counts"].decode("ascii")
+    return base64.b64encode(json.dumps(rle).encode("ascii")).decode("ascii")
+
 
 def mask_to_base64(mask: np.ndarray) -> str:
     # mask is likely a 2D numpy array (0/1 or 0-255)
-    # Convert to PIL Image
+    # Binary masks are sent as COCO RLE, anything else as PNG (see frontend/lib/mask.ts)
     try:
-        # Ensure mask is 2D
-        if mask.ndim == 3:
-            if mask.shape[2] == 1:
-                mask = mask[:, :, 0]
-            elif mask.shape[0] == 1:
-                mask = mask[0]
-            else:
-                # Convert RGB to grayscale
-                mask = np.mean(mask, axis=2)
+        mask = _mask_to_2d(mask)
         
-        if mask.dtype == bool:
-            mask = (mask * 255).astype(np.uint8)
-        elif mask.max() <= 1:
-            mask = (mask * 255).astype(np.uint8)
-        else:
-            mask = mask.astype(np.uint8)
+        if mask_utils is not None and (
+                mask.dtype == bool or (np.issubdtype(mask.dtype, np.integer) and mask.max() <= 1)):
+            return _encode_rle(mask)
         
-        img = Image.fromarray(mask)
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        import cv2
+        # Grayscale PNG through OpenCV's libpng; low compression is cheap and still small for masks
+        ok, buf = cv2.imencode(".png", _normalize_mask_uint8(mask), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        return base64.b64encode(buf.tobytes()).decode("ascii") if ok else ""
     except Exception as e:
         print(f"Error encoding mask: {e}")
         return ""
 
 def get_cleaned_obbs(mask):
     import cv2
+    from scipy import ndimage
     
-    # Ensure mask is 2D - if 3D, take first channel or convert to grayscale
-    if mask.ndim == 3:
-        if mask.shape[2] == 1:
-            mask = mask[:, :, 0]
-        elif mask.shape[0] == 1:
-            mask = mask[0]
-        else:
-            # Convert RGB to grayscale
-            mask = np.mean(mask, axis=2)
-    
-    # Ensure mask is uint8
-    if mask.dtype == bool:
-        mask = (mask * 255).astype(np.uint8)
-    elif mask.max() <= 1:
-        mask = (mask * 255).astype(np.uint8)
-    else:
-        mask = mask.astype(np.uint8)
+    mask = _normalize_mask_uint8(mask)
 
     # Get image dimensions for normalization
     height, width = mask.shape[:2]
@@ -93,22 +113,44 @@ def get_cleaned_obbs(mask):
     markers = cv2.watershed(img_for_watershed, markers)
 
     # Collect contours from separated objects
-    valid_contours = []
-    unique_labels = np.unique(markers)
-    
-    for label in unique_labels:
-        if label <= 1: # 0 is unknown/boundary, 1 is background
-            continue
-            
-        # Create mask for this object
-        obj_mask = np.zeros_like(mask, dtype=np.uint8)
-        obj_mask[markers == label] = 255
-        
-        contours, _ = cv2.findContours(obj_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        if contours:
-            c = max(contours, key=cv2.contourArea)
-            valid_contours.append(c)
+    # Bounding slices of every label in one linear pass (None for absent labels), so each
+    # object is traced within its ROI; 0 / -1 (unknown, boundary) are skipped by find_objects
+    label_slices = ndimage.find_objects(markers)
+    # Label 1 is background
+    jobs = [(markers, label, roi) for label, roi in enumerate(label_slices[1:], start=2) if roi is not None]
+    
+    # OpenCV releases the GIL, so many objects are traced in parallel
+    if len(jobs) >= CONTOUR_PARALLEL_MIN:
+        contours = list(_get_contour_pool().map(_largest_label_contour, jobs))
+    else:
+        contours = [_largest_label_contour(job) for job in jobs]
+    valid_contours = [c for c in contours if c is not None]
 
+    return _contours_to_obbs(valid_contours, width, height)
+
+def _largest_label_contour(job):
+    """Largest external contour (image coords) of one watershed label, traced within its ROI."""
+    import cv2
+    
+    markers, label, (rows, cols) = job
+    obj_mask = (markers[rows, cols] == label).view(np.uint8)
+    contours, _ = cv2.findContours(obj_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=(cols.start, rows.start))
+    if not contours:
+        return None
+    return max(contours, key=cv2.contourArea)
+
+def _get_contour_pool() -> ThreadPoolExecutor:
+    global _contour_pool
+    if _contour_pool is None:
+        _contour_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                                           thread_name_prefix="contours")
+    return _contour_pool
+
+def _contours_to_obbs(valid_contours, width, height):
+    """Normalized OBBs of the contours at least a quarter of the mean contour area."""
+    import cv2
+    
     if not valid_contours:
         return []
 
@@ -119,20 +161,24 @@ def get_cleaned_obbs(mask):
     mean_area = np.mean(areas)
     threshold = 0.25 * mean_area
 
+    # Normalize coordinates: x by width, y by height (in float64)
+    scale = np.array([width, height], dtype=np.float64)
     obbs = []
     for c, area in zip(valid_contours, areas):
         if area >= threshold:
             rect = cv2.minAreaRect(c)
             box = cv2.boxPoints(rect)
-            # Normalize coordinates: x by width, y by height
             # Format: (x1, y1, x2, y2, x3, y3, x4, y4)
-            normalized_box = []
-            for point in box:
-                normalized_box.append(float(point[0] / width))   # x-coordinate
-                normalized_box.append(float(point[1] / height))  # y-coordinate
-            obbs.append(normalized_box)
+            obbs.append((box.astype(np.float64) / scale).ravel().tolist())
     return obbs
 
+async def resolve_frames(frames) -> list:
+    """Frames as PIL images, given PIL images / RGB ndarrays or an ObjectRef to a list of them."""
+    import ray
+    if isinstance(frames, ray.ObjectRef):
+        frames = await frames
+    return [Image.fromarray(f) if isinstance(f, np.ndarray) else f for f in frames]
+
 def get_seg_hidden_states(hidden_states, output_ids, seg_id):
     seg_mask = output_ids == seg_id
     n_out = len(seg_mask)
@@ -154,23 +200,7 @@ def calculate_area_from_mask(mask: np.ndarray, gsd: float) -> float:
     """
     import cv2
     
-    # Ensure mask is 2D
-    if mask.ndim == 3:
-        if mask.shape[2] == 1:
-            mask = mask[:, :, 0]
-        elif mask.shape[0] == 1:
-            mask = mask[0]
-        else:
-            # Convert RGB to grayscale
-            mask = np.mean(mask, axis=2)
-    
-    # Ensure mask is uint8
-    if mask.dtype == bool:
-        mask = (mask * 255).astype(np.uint8)
-    elif mask.max() <= 1:
-        mask = (mask * 255).astype(np.uint8)
-    else:
-        mask = mask.astype(np.uint8)
+    mask = _normalize_mask_uint8(mask)
     
     # Check if mask is empty
     if cv2.countNonZero(mask) == 0:
@@ -5,6 +5,7 @@ import Sidebar from '@/components/Sidebar';
 import ImagePanel from '@/components/ImagePanel';
 import ChatbotPanel from '@/components/ChatbotPanel';
 import { apiClient } from '@/lib/api';
+import { maskToDataUrl } from '@/lib/mask';
 import {
   ChatMessage,
   BoundingBox,
@@ -493,8 +494,8 @@ export default function Home() {
       
       // Handle mask overlay for localization
       if (response.mask && queryType === 'localisation') {
-        // Convert base64 mask to data URL
-        const maskDataUrl = `data:image/png;base64,${response.mask}`;
+        // Convert base64 mask (COCO RLE or PNG) to data URL
+        const maskDataUrl = maskToDataUrl(response.mask);
         setMaskUrl(maskDataUrl);
       } else {
         setMaskUrl(null);
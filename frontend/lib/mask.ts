@@ -0,0 +1,78 @@
+// Helpers for masks returned by /predict, /earthmind, /remotesam
+
+interface CocoRle {
+  size: [number, number];  // [height, width]
+  counts: string;  // COCO compressed RLE string
+}
+
+// Decode a COCO compressed RLE string into run lengths (column-major, starting with zeros)
+function decodeRleCounts(s: string): number[] {
+  const counts: number[] = [];
+  let p = 0;
+  while (p < s.length) {
+    let x = 0;
+    let k = 0;
+    let more = true;
+    while (more) {
+      const c = s.charCodeAt(p) - 48;
+      x |= (c & 0x1f) << (5 * k);
+      more = (c & 0x20) !== 0;
+      p++;
+      k++;
+      if (!more && (c & 0x10)) {
+        x |= -1 << (5 * k);
+      }
+    }
+    if (counts.length > 2) {
+      x += counts[counts.length - 2];
+    }
+    counts.push(x);
+  }
+  return counts;
+}
+
+// Render a COCO RLE mask to a grayscale PNG data URL (0 -> black, 1 -> white)
+function rleToDataUrl(rle: CocoRle): string | null {
+  const [height, width] = rle.size;
+  const canvas = document.createElement('canvas');
+  canvas.width = width;
+  canvas.height = height;
+  const ctx = canvas.getContext('2d');
+  if (!ctx) return null;
+
+  const image = ctx.createImageData(width, height);
+  const pixels = image.data;
+  for (let i = 3; i < pixels.length; i += 4) {
+    pixels[i] = 255;  // Opaque, like the PNG masks
+  }
+
+  let idx = 0;
+  const counts = decodeRleCounts(rle.counts);
+  counts.forEach((run, j) => {
+    if (j % 2 === 1) {
+      // Runs walk the mask column by column
+      for (let n = idx; n < idx + run; n++) {
+        const offset = ((n % height) * width + Math.floor(n / height)) * 4;
+        pixels[offset] = pixels[offset + 1] = pixels[offset + 2] = 255;
+      }
+    }
+    idx += run;
+  });
+
+  ctx.putImageData(image, 0, 0);
+  return canvas.toDataURL('image/png');
+}
+
+// Convert a base64 mask (COCO RLE JSON for binary masks, PNG otherwise) to an image data URL
+export function maskToDataUrl(maskB64: string): string | null {
+  try {
+    const decoded = atob(maskB64);
+    if (decoded.startsWith('{')) {
+      return rleToDataUrl(JSON.parse(decoded) as CocoRle);
+    }
+    return `data:image/png;base64,${maskB64}`;
+  } catch (error) {
+    console.error('Failed to decode mask:', error);
+    return null;
+  }
+}
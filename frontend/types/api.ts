@@ -152,7 +152,7 @@ export interface PredictRequest {
 // Response type for /predict, /earthmind, /remotesam endpoints
 export interface PredictResponse {
   prediction: string;
-  mask: string;  // base64 encoded PNG mask (empty string if no mask)
+  mask: string;  // base64 encoded mask: COCO RLE JSON for binary masks, PNG otherwise (empty string if no mask)
   obbs: number[][];  // Oriented Bounding Boxes, each box is [x1,y1,x2,y2,x3,y3,x4,y4] (8 values)
 }
 